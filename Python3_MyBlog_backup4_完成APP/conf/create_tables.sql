@@ -30,8 +30,12 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
+    `renderer` varchar(50) not null,
     `created_at` real not null,
+    `updated_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_renderer` (`renderer`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -45,6 +49,7 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -7,7 +7,7 @@ __author__ = 'Toohoo Lee'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     """
@@ -43,6 +43,9 @@ class Page(object):
         # page_count 需要多少页将文章显示出来
         self.item_count = item_count
         self.page_size = page_size
+        # 页码小于1的都当作第一页
+        if page_index < 1:
+            page_index = 1
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
         if (item_count == 0) or (page_index > self.page_count):
             self.offset = 0
@@ -65,6 +68,60 @@ class Page(object):
     __repr__ = __str__
 
 
+class CursorPage(object):
+    """
+    Cursor (keyset) pagination by (created_at, id), no offset is needed for deep pages.
+    >>>p = CursorPage('')
+    >>>p.after is None
+    True
+    >>>p.limit
+    11
+    >>>items = p.trim([dict(created_at=10 - i, id=str(i)) for i in range(11)])
+    >>>len(items), p.has_next
+    (10, True)
+    >>>CursorPage(p.next_cursor).after
+    (1, '9')
+    """
+    def __init__(self, cursor='', page_size=10):
+        self.page_size = page_size
+        # 多取一条，用来判断后面是否还有数据
+        self.limit = page_size + 1
+        self.after = decode_cursor(cursor) if cursor else None
+        self.has_next = False
+        self.next_cursor = None
+
+    # 去掉多取的那一条，并生成下一页的游标
+    def trim(self, items):
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            last = items[-1]
+            self.next_cursor = encode_cursor(last['created_at'], last['id'])
+        return items
+
+    def __str__(self):
+        return 'page_size: %s, after: %s, has_next: %s' % (self.page_size, self.after, self.has_next)
+
+    __repr__ = __str__
+
+
+# 游标对客户端来说是不透明的字符串，内容是上一页最后一条记录的(created_at, id)
+def encode_cursor(created_at, id):
+    s = json.dumps([created_at, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, id = json.loads(s)
+        if not isinstance(created_at, (int, float)) or not isinstance(id, str):
+            raise ValueError(s)
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return created_at, id
+
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional)
@@ -7,21 +7,26 @@ __author__ = 'Toohoo lee'
 async web application.
 '''
 
-# 导入日志，并设置格式
-import logging;logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(name)s:%(levelname)s: %(message)s")
+# 导入日志，并设置格式，日志经过队列由后台线程输出，见logconfig.py
+import logging, logconfig;logconfig.setup()
 
-import asyncio, os, json, time
+import asyncio, os, sys, time
 from datetime import datetime
 from aiohttp import web
 
 # 加入注册支持, FileSystemLoader 是文件系统加载器， 用来加载模板路径
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from config import configs
 
-import orm
+import orm, render, serializer, pagecache, conditional, metrics
 from coroweb import add_routes, add_static
 from handlers import cookie2user, COOKIE_NAME
 
+# 每个请求都会输出的日志，级别和采样比例在configs.logging中设置
+_log = logging.getLogger(logconfig.REQUEST)
+
+_STREAM_CHUNK_SIZE = configs.templates.stream_chunk_size
+
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
@@ -35,8 +40,16 @@ def init_jinja2(app, **kw):
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
         # 当模板文件被修改之后，下次请求加载该模板文件的时候就会自动重新加载修改后的模板文件
-        auto_reload = kw.get('auto_reload', True)
+        # 每次渲染都要检查模板文件是否修改过，所以只在debug模式下打开
+        auto_reload = kw.get('auto_reload', configs.debug)
     )
+    # 模板编译之后的字节码保存到文件，重启之后直接加载，不用重新编译
+    bytecode_cache = kw.get('bytecode_cache', configs.templates.bytecode_cache)
+    if bytecode_cache:
+        if not os.path.isdir(bytecode_cache):
+            os.makedirs(bytecode_cache)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+        logging.info('set jinja2 bytecode cache: %s' % bytecode_cache)
     # 获取模板文件的位置
     path = kw.get('path', None)
     if path is None:
@@ -49,16 +62,56 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    # 预先编译所有模板，第一个请求不用等待编译，同时也会写入字节码缓存
+    if kw.get('precompile', configs.templates.precompile):
+        precompile_templates(env)
     # 所有的一切是为了给app添加__templating__字段
     # 前面将jinja2的环境配置都赋值给了env了，这里再把env存入app的dict中，这样app就知道要到哪里去找模板，怎样解析模板。
     app['__templating__'] = env
 
+
+def precompile_templates(env):
+    names = env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        env.get_template(name)
+    logging.info('precompiled %s templates.' % len(names))
+    return names
+
+
+# 最外层的中间件：记录每个路由的耗时和状态码，以及请求中查询数据库、渲染markdown和模板的时间（见metrics.py），
+# debug模式下通过Server-Timing响应头给出这些时间，浏览器的开发者工具里可以直接看到
+async def metrics_factory(app, handler):
+    async def timing(request):
+        started = time.perf_counter()
+        t = metrics.start_request()
+        resp = None
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            cost = time.perf_counter() - started
+            info = request.match_info.get_info()
+            route = info.get('formatter') or info.get('path') or info.get('prefix') or 'unmatched'
+            metrics.finish_request(request.method, route, status, cost, t)
+            if configs.debug and resp is not None and not resp.prepared:
+                resp.headers['Server-Timing'] = t.server_timing(cost)
+    return timing
+
+
 # 中间件可以改变URL的输入、输出，甚至可以决定不继续处理而直接返回。middleware的用处就是在于把通用的功能从每个URL处理函数中拿出来，
 # 集中放到一个地方。
 # 这个函数的作用就是当有http请求的时候，通过logging.info 输出请求的信息，其中包括请求的路径和方法
 async def logger_factory(app, handler):
     async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
+        # 决定这个请求的日志（包括SQL和参数）是否输出；参数在日志确实要输出的时候才拼接
+        logconfig.sample_request()
+        _log.info('Request: %s %s', request.method, request.path,
+                  extra=dict(method=request.method, path=request.path))
         # await asyncio.sleep(0.3)
         # handler 为处理函数，request为参数
         return (await handler(request))
@@ -67,16 +120,19 @@ async def logger_factory(app, handler):
 
 # 利用middleware在处理URL之前，把cookie解析出来，并将登录用户绑定到request对象上，这样，后续的URL处理函数就可以直接拿到登录用户：
 async def auth_factory(app, handler):
+    anonymous_paths = tuple(configs.session.anonymous_paths)
     async def auth(request):
-        logging.info('check user:%s %s' % (request.method, request.path))
+        _log.debug('check user: %s %s', request.method, request.path)
         request.__user__ = None
+        # 静态文件等不需要用户信息的请求直接跳过
+        if request.path.startswith(anonymous_paths):
+            return await handler(request)
         # cookies是用分号分割的一组键值对，在python中被看做是dict
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             user = await cookie2user(cookie_str)
-            print(user)
             if user:
-                logging.info('set current user:%s' % user.email)
+                _log.debug('set current user: %s', user.email)
                 request.__user__ = user
         # 如果以manage开头的，必须先以管理员的角色登录
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
@@ -84,15 +140,42 @@ async def auth_factory(app, handler):
         return await handler(request)
     return auth
 
+# 条件请求：给GET请求的完整响应加上ETag，客户端带着If-None-Match/If-Modified-Since来请求，
+# 内容没有变化就只返回304，不再传输整个页面。放在整页缓存外面，缓存命中的页面同样可以返回304
+async def conditional_factory(app, handler):
+    async def conditional_get(request):
+        return conditional.finish(request, await handler(request))
+    return conditional_get
+
+
+# 整页缓存：匿名用户的GET请求，并且URL处理函数用@cached声明了tag，直接返回缓存的页面，
+# 不用查询数据库也不用渲染模板。博客和评论的写接口会按tag让缓存失效
+async def cache_factory(app, handler):
+    async def cache(request):
+        tags = getattr(request.match_info.handler, 'cache_tags', None)
+        if tags is None or request.method != 'GET' or request.__user__ is not None or not pagecache.enabled():
+            return await handler(request)
+        tags = tuple(tag.format(**request.match_info) for tag in tags)
+        # 缓存的页面必须是完整的200响应：带条件头的请求，URL处理函数可能直接返回304，既不能写入缓存，
+        # 后台刷新过期页面时也会一直拿到304。所以交给URL处理函数的是去掉条件头的副本，304由外面的conditional_factory判断
+        # 后台刷新过期页面时buffered为True，不能分块输出
+        def fill(buffered):
+            fresh = conditional.unconditional(request)
+            pagecache.prepare_request(fresh, buffered)
+            return handler(fresh)
+        return await pagecache.get(request.path_qs, tags, fill)
+    return cache
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                _log.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                _log.debug('request form: %s', request.__data__)
         return (await handler(request))
     # 返回函数parse_data
     return parse_data
@@ -109,7 +192,7 @@ async def data_factory(app, handler):
 # 注意：在response_factory中应用了jinja2来渲染模板文件
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        _log.debug('Response handler...')
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -127,15 +210,26 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o:o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
+                # 没有模板就返回JSON，很大的列表会分块输出
+                return await serializer.dict_response(request, r)
             else:
                 # 对模板进行渲染, 例如登录成功之后将__user__赋值为对应的登录用户，
                 # 注意要加上第一句，同时在下面的init的app中加上auth_factory！
+                # URL处理函数可以通过__last_modified__给出页面的修改时间，客户端的副本没有过期就不用渲染模板了
+                modified = r.get('__last_modified__')
+                if modified is not None and conditional.is_fresh(request, modified=modified):
+                    return conditional.set_last_modified(conditional.not_modified(), modified)
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                # URL处理函数给出__stream__的页面分块输出，后台刷新整页缓存时除外
+                if r.get('__stream__') and not pagecache.buffered(request):
+                    return await stream_template(request, app['__templating__'].get_template(template), r, modified)
+                started = time.perf_counter()
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                metrics.observe_render('template', time.perf_counter() - started)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
+                if modified is not None:
+                    conditional.set_last_modified(resp, modified)
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
@@ -150,6 +244,51 @@ async def response_factory(app, handler):
     return response
 
 
+# 用模板的generate()边渲染边输出：每攒够一块就写出去并让出事件循环，不用先拼出整个页面，客户端也更早收到第一个字节。
+# 分块输出的响应没有ETag；生成整页缓存的请求把写出的各块交给整页缓存，等待这个页面的请求直接使用缓存，不用再渲染一遍。
+# 开始输出之后再出错，只能断开连接。模板的耗时只算generate本身，不包括写出去的时间
+async def stream_template(request, template, r, modified=None):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    if modified is not None:
+        conditional.set_last_modified(resp, modified)
+        conditional.set_cache_control(request, resp)
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    cost = 0.0
+    parts = []
+    size = 0
+    written = pagecache.stream_collector(request)
+    generator = template.generate(**r)
+    while True:
+        started = time.perf_counter()
+        s = next(generator, None)
+        cost += time.perf_counter() - started
+        if s is not None:
+            parts.append(s)
+            size += len(s)
+            if size < _STREAM_CHUNK_SIZE:
+                continue
+        text = ''.join(parts)
+        # 单个很长的片段（比如整篇博客正文）也按块编码，不用一次编码成一个很大的bytes对象
+        for i in range(0, len(text), _STREAM_CHUNK_SIZE):
+            chunk = text[i:i + _STREAM_CHUNK_SIZE].encode('utf-8')
+            if written is not None:
+                written.append(chunk)
+            await resp.write(chunk)
+        await asyncio.sleep(0)
+        if s is None:
+            break
+        parts = []
+        size = 0
+    await resp.write_eof()
+    metrics.observe_render('template', cost)
+    if written is not None:
+        pagecache.set_streamed_body(resp, written)
+    return resp
+
+
 def datetime_filter(t):
     delta =int(time.time() - t)
     if delta < 60:
@@ -164,10 +303,13 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-# 更新使用async实现
-async def init(loop):
+# 创建app：数据库连接池、渲染进程池、middleware和URL处理函数，不包括监听端口
+# 单进程运行时由startup.start调用，多进程部署时（见prefork.py）每个工作进程各自调用一次，各自拥有自己的连接池
+async def init_app(loop, background=True):
     #await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='toohoo', password='123', db='myblogdb')
     await orm.create_pool(loop=loop, **configs.db)
+    # 启动markdown渲染进程池
+    render.start_pool()
     # middleware（中间件）设置3个中间处理函数（都是装饰器）
     # middleware中的每个factory接受两个参数，app和handler（即middleware的下一个handler）
     # 例如这里的logger_factory的handler参数其实就是auth_factory
@@ -175,23 +317,44 @@ async def init(loop):
     # 这里是装饰模式的体现，logger_factory, auth_factory, response_factory都是URL处理函数前（如handler.index）的装饰功能
     # 这里要加上auth_factory，否则会报错：request没有属性__user__,同时刷新首页显示当前登录用户
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        metrics_factory, logger_factory, auth_factory, conditional_factory, cache_factory, response_factory
     ])
     init_jinja2(app, filters = dict(datetime=datetime_filter))
     # 添加URL处理函数
     add_routes(app, 'handlers')
     # 添加CSS等静态文件路径
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9999)
+    # 后台重新渲染渲染器版本过期的博客，多进程部署时只需要一个进程来做
+    # 保留任务的引用，关闭app时取消还没有完成的任务
+    if background:
+        app['__rerender__'] = loop.create_task(render.rerender_stale_blogs())
+    return app
+
+
+# 释放init_app创建的资源
+async def close_app(app):
+    task = app.get('__rerender__')
+    if task is not None and not task.done():
+        task.cancel()
+    render.shutdown_pool()
+    await orm.close_pool()
+
+
+# 部署的时候执行 python3 app.py warm-templates，预先编译模板并写入字节码缓存
+def warm_templates():
+    if not configs.templates.bytecode_cache:
+        logging.warning('configs.templates.bytecode_cache is not set, compiled templates will not be kept.')
+    templating = dict()
+    init_jinja2(templating, filters=dict(datetime=datetime_filter), precompile=True)
 
-    logging.info('server started at http://127.0.0.1:9999...')
-    return srv
 
-# 获取eventloop
-loop = asyncio.get_event_loop()
-# 然后加入运行事件
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    if sys.argv[1:] == ['warm-templates']:
+        warm_templates()
+        sys.exit(0)
+    # 事件循环、监听端口和优雅退出见startup.py
+    import startup
+    startup.run()
 
 
 
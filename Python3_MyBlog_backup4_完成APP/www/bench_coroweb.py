@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Micro-benchmark of the argument binding in coroweb.RequestHandler.
+
+Usage: python3 bench_coroweb.py [calls]
+'''
+
+import sys, time, asyncio, logging
+
+from urllib import parse
+
+import coroweb
+
+
+# 模拟aiohttp的request，只提供参数绑定用到的属性
+class FakeRequest(object):
+
+    def __init__(self, method='GET', query_string='', match_info=None, content_type='', body=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = content_type
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+    async def post(self):
+        return self._body
+
+
+# 优化之前的RequestHandler：__init__中分析函数参数，__call__中每个请求都要执行下面的参数处理，用来对比
+def legacy_binder(fn):
+    has_var_kw_arg = coroweb.has_var_kw_arg(fn)
+    has_named_kw_args = coroweb.has_named_kw_args(fn)
+    named_kw_args = coroweb.get_named_kw_args(fn)
+    required_kw_args = coroweb.get_required_kw_args(fn)
+    has_request_arg = coroweb.has_request_arg(fn)
+
+    async def bind(request):
+        return await legacy_bind(request, has_var_kw_arg, has_named_kw_args, named_kw_args, required_kw_args,
+                                 has_request_arg)
+    return bind
+
+
+async def legacy_bind(request, has_var_kw_arg, has_named_kw_args, named_kw_args, required_kw_args, has_request_arg):
+    kw = None
+    if has_var_kw_arg or has_named_kw_args or required_kw_args:
+        if request.method == 'POST':
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                kw = await request.json()
+            else:
+                kw = dict(**(await request.post()))
+        if request.method == 'GET':
+            qs = request.query_string
+            if qs:
+                kw = dict()
+                for k, v in parse.parse_qs(qs, True).items():
+                    kw[k] = v[0]
+    if kw is None:
+        kw = dict(**request.match_info)
+    else:
+        if not has_var_kw_arg and named_kw_args:
+            copy = dict()
+            for name in named_kw_args:
+                if name in kw:
+                    copy[name] = kw[name]
+            kw = copy
+        for k, v in request.match_info.items():
+            kw[k] = v
+    if has_request_arg:
+        kw['request'] = request
+    for name in required_kw_args:
+        if not name in kw:
+            return None
+    logging.info('call with args: %s' % str(kw))
+    return kw
+
+
+async def index(*, page='1'):
+    pass
+
+
+async def get_blog(id, *, cursor=''):
+    pass
+
+
+async def api_create_blog(request, *, name, summary, content):
+    pass
+
+
+CASES = [
+    ('GET /?page=3', index, FakeRequest(query_string='page=3')),
+    ('GET /blog/{id}', get_blog, FakeRequest(match_info={'id': '0015'})),
+    ('POST /api/blogs', api_create_blog, FakeRequest('POST', content_type='application/json',
+                                                     body=dict(name='n', summary='s', content='c'))),
+]
+
+
+async def run(bind, request, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await bind(request)
+    return calls / (time.perf_counter() - started)
+
+
+async def main(calls):
+    # 和线上一样，INFO级别的日志会被格式化但是不输出到终端
+    logging.basicConfig(level=logging.INFO, stream=open('/dev/null', 'w'))
+    print('%-20s %15s %15s %8s' % ('case', 'before calls/s', 'after calls/s', 'speedup'))
+    for name, fn, request in CASES:
+        before = await run(legacy_binder(fn), request, calls)
+        after = await run(coroweb.compile_binder(fn), request, calls)
+        print('%-20s %15.0f %15.0f %7.1fx' % (name, before, after, after / before))
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Benchmark of the markdown2 engines on generated blog posts of 1 KB, 100 KB and 1 MB,
+both ordinary and code-heavy ones, of re-rendering a post after a one-line edit,
+and of the md5 placeholders markdown2 used to make against the counter placeholders.
+
+Usage: python3 bench_markdown2.py [repeat]
+'''
+
+import sys, time, random
+
+from hashlib import md5
+
+import markdown2
+
+SIZES = [('1 KB', 1024), ('100 KB', 100 * 1024), ('1 MB', 1024 * 1024)]
+
+WORDS = ('the quick brown fox jumps over lazy dog asyncio aiohttp markdown render cache '
+         'request handler model blog comment user page template').split()
+
+
+def _sentence(r):
+    words = [r.choice(WORDS) for _ in range(r.randint(6, 16))]
+    i = r.randrange(len(words))
+    words[i] = r.choice(['*%s*', '**%s**', '`%s()`', '[%s](http://example.com/%s)', '[%s][ref]', '%s'])\
+        .replace('%s', words[i])
+    return ' '.join(words).capitalize() + '.'
+
+
+def _paragraph(r):
+    return '\n'.join(_sentence(r) for _ in range(r.randint(2, 5)))
+
+
+def _code(r):
+    return '\n'.join('    %sawait %s(%s)' % ('    ' * r.randint(0, 2), r.choice(WORDS), r.choice(WORDS))
+                     for _ in range(r.randint(3, 12)))
+
+
+def _list(r):
+    marker = r.choice(['-', '*', '1.'])
+    return '\n'.join('%s %s' % (marker, _sentence(r)) for _ in range(r.randint(2, 6)))
+
+
+# 和真实的博客文章差不多：标题、段落为主，夹杂代码块、列表和引用
+def _section(r):
+    blocks = ['## %s' % _sentence(r)[:-1]]
+    for _ in range(r.randint(3, 8)):
+        blocks.append(r.choice([_paragraph, _paragraph, _paragraph, _code, _list,
+                                lambda r: '> ' + _paragraph(r)])(r))
+    return '\n\n'.join(blocks)
+
+
+# 代码为主的文章：几乎每段都有代码块，行内代码也多，要暂存的代码片段最多
+def _code_section(r):
+    blocks = ['## %s' % _sentence(r)[:-1]]
+    for _ in range(r.randint(3, 8)):
+        blocks.append(_code(r))
+        blocks.append(' '.join('`%s.%s()`' % (r.choice(WORDS), r.choice(WORDS)) if r.random() < 0.3 else _sentence(r)
+                               for _ in range(r.randint(2, 6))))
+    return '\n\n'.join(blocks)
+
+
+KINDS = [('post', _section), ('code', _code_section)]
+
+
+def document(size, seed=0, section=_section):
+    r = random.Random(seed)
+    sections = ['[ref]: http://example.com/ref "Reference"']
+    total = 0
+    while total < size:
+        sections.append(section(r))
+        total += len(sections[-1]) + 2
+    return '\n\n'.join(sections)[:size].rsplit('\n\n', 1)[0] + '\n'
+
+
+def run(engine, text, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        html = markdown2.markdown(text, engine=engine)
+        cost = time.perf_counter() - started
+        best = cost if best is None else min(best, cost)
+    return best, html
+
+
+# 在文章中间的某一行末尾加几个字，模拟一次小修改
+def _edit(text, n):
+    lines = text.split('\n')
+    i = len(lines) // 2
+    while not lines[i][:1].isalpha():
+        i += 1
+    lines[i] += ' edited %s' % n
+    return '\n'.join(lines)
+
+
+def incremental(repeat):
+    print('%-6s %-8s %12s %15s %8s %10s' % ('kind', 'size', 'full ms', 'incremental ms', 'speedup', 'identical'))
+    converter = markdown2.Markdown(engine='tokenizer')
+    for kind, section in KINDS:
+        for name, size in SIZES[1:]:
+            text = document(size, section=section)
+            cache = markdown2.BlockCache(max_entries=1000000)
+            converter.convert(text, block_cache=cache)
+            full = cost = None
+            # 每次都是一处新的修改，只有改动的那个块不在缓存中
+            for i in range(repeat):
+                edited = _edit(text, i)
+                started = time.perf_counter()
+                html = converter.convert(edited, block_cache=cache)
+                c = time.perf_counter() - started
+                cost = c if cost is None else min(cost, c)
+            started = time.perf_counter()
+            expected = converter.convert(edited)
+            full = time.perf_counter() - started
+            print('%-6s %-8s %12.1f %15.1f %7.1fx %10s' % (kind, name, full * 1000, cost * 1000, full / cost,
+                                                          html == expected))
+
+
+# 原来的占位符：随机长度（0到1 MB个零字节，这里取平均值）的salt加上文本的md5，换回时每个占位符replace一遍全文
+_SECRET_SALT = bytes(500000)
+
+
+class Md5Markdown(markdown2.Markdown):
+    ' markdown2 with the md5 placeholders it used before the counter ones. '
+
+    def _hash_text(self, s, table):
+        key = 'md5-' + md5(_SECRET_SALT + s.encode('utf-8')).hexdigest()
+        table[key] = s
+        return key
+
+    # 后加入的占位符可能包含先加入的（比如代码中的转义字符），所以倒序替换
+    def _unhash(self, text, table):
+        for key, value in reversed(list(table.items())):
+            text = text.replace(key, value)
+        return text
+
+    def _unescape_special_chars(self, text):
+        return self._unhash(text, self._unescape_table)
+
+
+def placeholders(repeat):
+    # 代码为主的文章，要暂存的代码片段最多
+    print('%-9s %-8s %12s %15s %8s %10s' % ('engine', 'size', 'md5 ms', 'counter ms', 'speedup', 'identical'))
+    for engine in ('regex', 'tokenizer'):
+        old, new = Md5Markdown(engine=engine), markdown2.Markdown(engine=engine)
+        # md5的版本太慢，只跑到100 KB
+        for name, size in SIZES[:2]:
+            text = document(size, section=_code_section)
+            before = after = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                expected = old.convert(text)
+                c = time.perf_counter() - started
+                before = c if before is None else min(before, c)
+                started = time.perf_counter()
+                html = new.convert(text)
+                c = time.perf_counter() - started
+                after = c if after is None else min(after, c)
+            print('%-9s %-8s %12.1f %15.1f %7.1fx %10s' % (engine, name, before * 1000, after * 1000, before / after,
+                                                          html == expected))
+
+
+def main(repeat):
+    print('%-6s %-8s %12s %15s %8s %10s' % ('kind', 'size', 'regex ms', 'tokenizer ms', 'speedup', 'identical'))
+    for kind, section in KINDS:
+        for name, size in SIZES:
+            text = document(size, section=section)
+            # 1 MB的文档只跑一次，否则太慢
+            n = repeat if size < 1024 * 1024 else 1
+            before, expected = run('regex', text, n)
+            after, html = run('tokenizer', text, n)
+            print('%-6s %-8s %12.1f %15.1f %7.1fx %10s' % (kind, name, before * 1000, after * 1000, before / after,
+                                                          html == expected))
+    print()
+    incremental(repeat)
+    print()
+    placeholders(repeat)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
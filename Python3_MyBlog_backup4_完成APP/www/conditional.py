@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Conditional GET: ETag / Last-Modified validators and 304 responses.
+'''
+
+import time, hashlib
+
+from aiohttp import web
+
+# 模板和渲染器只会随着重新部署而改变，所以页面的修改时间不会早于进程启动的时间，
+# 否则部署了新模板之后，带着If-Modified-Since的客户端会一直拿到304
+STARTED = time.time()
+
+# 304响应需要带上的响应头
+_NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Vary', 'Expires')
+
+# 条件请求的请求头
+_CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+
+def etag(body):
+    ' strong entity tag of the response body. '
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def last_modified(t):
+    return max(t, STARTED)
+
+
+# If-None-Match可以是*，也可以是逗号分隔的多个ETag，比较的时候忽略弱ETag的W/前缀
+def _etag_matches(if_none_match, tag):
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate == tag:
+            return True
+        if candidate.startswith('W/') and candidate[2:] == tag:
+            return True
+    return False
+
+
+def is_fresh(request, tag=None, modified=None):
+    ' return True if the client copy validated by tag / modified is still current. '
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    # 同时带有两个条件的时候以If-None-Match为准
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return tag is not None and _etag_matches(if_none_match, tag)
+    # 页面上显示了当前登录的用户，而修改时间不包含登录状态，所以只对匿名用户按时间判断
+    if modified is None or getattr(request, '__user__', None) is not None:
+        return False
+    since = request.if_modified_since
+    return since is not None and int(last_modified(modified)) <= since.timestamp()
+
+
+def unconditional(request):
+    ' a copy of request without the conditional GET headers, request itself if it has none. '
+    if not any(k in request.headers for k in _CONDITIONAL_HEADERS):
+        return request
+    headers = request.headers.copy()
+    for k in _CONDITIONAL_HEADERS:
+        headers.popall(k, None)
+    clone = request.clone(headers=headers)
+    clone.__user__ = request.__user__
+    return clone
+
+
+def not_modified(headers=None):
+    resp = web.Response(status=304)
+    if headers:
+        for k in _NOT_MODIFIED_HEADERS:
+            if k in headers:
+                resp.headers[k] = headers[k]
+    return resp
+
+
+def set_last_modified(resp, modified):
+    resp.last_modified = int(last_modified(modified))
+    return resp
+
+
+# 只有验证器没有Cache-Control的响应，浏览器会按Last-Modified自己估计一个有效期，这期间不来请求就看不到修改。
+# no-cache要求每次使用之前先验证；页面上显示了登录用户的响应还要加上private，不能存进共享的缓存
+def set_cache_control(request, resp):
+    if 'Cache-Control' in resp.headers or ('ETag' not in resp.headers and 'Last-Modified' not in resp.headers):
+        return resp
+    if getattr(request, '__user__', None) is not None:
+        resp.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+# 给完整的200响应加上ETag（整页缓存命中时已经带有ETag，不用再计算），客户端的副本仍然有效就返回304。
+# 分块输出的响应头已经发出去了，由stream_template自己加Cache-Control
+def finish(request, resp):
+    if request.method not in ('GET', 'HEAD') or resp.prepared:
+        return resp
+    if resp.status != 200 or not isinstance(resp, web.Response) or not isinstance(resp.body, bytes):
+        return set_cache_control(request, resp)
+    tag = resp.headers.get('ETag')
+    if tag is None:
+        tag = etag(resp.body)
+        resp.headers['ETag'] = tag
+    set_cache_control(request, resp)
+    modified = resp.last_modified
+    if is_fresh(request, tag, modified.timestamp() if modified is not None else None):
+        return not_modified(resp.headers)
+    return resp
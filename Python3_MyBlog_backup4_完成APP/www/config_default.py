@@ -9,14 +9,110 @@ __author__ = 'Toohoo Lee'
 
 configs = {
     'debug': True,
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9999,
+        # 设置了路径就监听这个Unix domain socket而不是host:port，nginx和应用在同一台机器上时少一次TCP握手
+        'unix_socket': None,
+        # 安装了uvloop就使用uvloop的事件循环
+        'uvloop': True,
+        # 等待accept的连接队列长度
+        'backlog': 128,
+        # 空闲的keep-alive连接保持的秒数
+        'keepalive_timeout': 75,
+        # 是否输出访问日志，以及访问日志的格式
+        'access_log': True,
+        'access_log_format': '%a %t "%r" %s %b "%{Referer}i" "%{User-Agent}i"',
+        # 收到SIGTERM之后等待正在处理的请求完成的秒数
+        'graceful_timeout': 30,
+        # 以下是prefork.py多进程部署的设置
+        # 工作进程数，0表示和CPU核数相同
+        'workers': 0,
+        # True: 每个工作进程各自用SO_REUSEPORT监听同一个端口，由内核分配连接；False: 主进程监听之后交给工作进程
+        'reuse_port': False,
+        # 工作进程每隔heartbeat秒向主进程报告一次状态，超过health_timeout秒没有报告就认为进程卡死，杀掉重启
+        'heartbeat': 5,
+        'health_timeout': 30,
+        # 主进程把各个工作进程的状态写到这个JSON文件，None表示不写
+        'status_file': None,
+        # 每个工作进程的指标是分开的，经过nginx抓取/metrics只能拿到随机一个进程的数据。
+        # 设置了metrics_port之后槽位N的工作进程还在metrics_host:metrics_port+N上单独提供/metrics，Prometheus逐个抓取
+        'metrics_host': '127.0.0.1',
+        'metrics_port': None
+    },
+    'logging': {
+        'level': 'INFO',
+        # json: 每条日志一行JSON；text: [时间] logger:级别: 消息
+        'format': 'json',
+        # 各类日志单独设置级别：请求、URL处理函数的参数、SQL语句以及aiohttp的访问日志
+        'levels': {
+            'myblog.request': 'INFO',
+            'myblog.handler': 'WARNING',
+            'myblog.sql': 'WARNING',
+            'aiohttp.access': 'INFO'
+        },
+        # 请求、参数和SQL日志只输出这个比例的请求（按请求采样，同一个请求的日志要么都输出要么都不输出）
+        'request_sample_rate': 0.1
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'toohoo',
         'password': '123',
-        'db': 'myblogdb'
+        'db': 'myblogdb',
+        # 连接池大小，以及连接空闲多少秒之后重新建立（-1表示不回收）
+        'minsize': 1,
+        'maxsize': 10,
+        'pool_recycle': 3600
     },
     'session': {
-        'secret': 'Myblogdb'
+        'secret': 'Myblogdb',
+        # 已验证登录状态的缓存秒数和条数
+        'cache_ttl': 60,
+        'cache_size': 10000,
+        # 不需要登录用户的路径前缀，这些请求不解析cookie，也不查询数据库
+        'anonymous_paths': ['/static/', '/favicon.ico']
+    },
+    'templates': {
+        # jinja2模板字节码缓存目录，重启之后不用重新编译模板；None表示不使用文件缓存
+        'bytecode_cache': None,
+        # 启动的时候预先编译所有模板
+        'precompile': True,
+        # 分块输出的页面，模板的输出每攒够stream_chunk_size个字符写一次
+        'stream_chunk_size': 16 * 1024
+    },
+    'page_cache': {
+        # 匿名用户的整页缓存：新鲜时间、过期后仍可返回旧页面的时间（秒）以及最多缓存的页面数
+        'enabled': True,
+        'ttl': 10,
+        'stale_ttl': 60,
+        'max_entries': 1000
+    },
+    'serializer': {
+        # JSON响应中的列表达到stream_threshold条时分块输出，每块chunk_size条
+        'stream_threshold': 500,
+        'chunk_size': 100
+    },
+    'render': {
+        # markdown2的块级处理方式：regex是原来的整篇文档逐个正则替换，tokenizer是按顶层块一遍切分，两者输出相同
+        'engine': 'tokenizer',
+        # 正文达到stream_threshold个字符的博客页面分块输出：模板边渲染边发送，不用先在内存中拼出整个页面
+        'stream_threshold': 64 * 1024,
+        # 博客正文HTML缓存：条目数、内存上限以及可选的落盘目录（None表示不落盘）
+        'cache': {
+            'max_entries': 256,
+            'max_bytes': 32 * 1024 * 1024,
+            'path': None
+        },
+        # 按顶层块缓存渲染结果（只对tokenizer有效）：修改文章之后只重新渲染改动过的块，max_entries是缓存的块数
+        'blocks': {
+            'max_entries': 20000
+        },
+        # 渲染进程池：进程数（0表示不使用进程池），小于inline_threshold个字符的文章直接渲染，超时秒数（超时之后杀掉工作进程，换一个新的进程池）
+        'pool': {
+            'workers': 2,
+            'inline_threshold': 4096,
+            'timeout': 10
+        }
     }
 }
@@ -8,6 +8,10 @@ Override configurations.
 __author__ = 'Toohoo Lee'
 
 configs = {
+    'server': {
+        # 和conf/nginx/myblog中upstream的地址一致
+        'unix_socket': '/srv/myblog/run/myblog.sock'
+    },
     'db': {
         'host': '127.0.0.1'
     }
@@ -3,13 +3,21 @@
 
 __author__ = 'Toohoo Lee'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, typing
 
 from urllib import parse
 
 from aiohttp import web
 
-from apis import APIError
+from apis import APIError, APIValueError
+
+try:
+    import dataclasses
+except ImportError:
+    dataclasses = None
+
+# URL处理函数调用参数的日志，默认级别是WARNING，需要时在configs.logging.levels中打开
+_log = logging.getLogger('myblog.handler')
 
 # @get和@post 要把一个函数映射成为一个URL处理函数
 # 定义完成之后一个函数通过@get()或者@post的装饰器就附带了URL信息
@@ -45,6 +53,19 @@ def post(path):
     return decorator
 
 
+def cached(*tags):
+    '''
+    Define decorator @cached('tag', ...) for pages that can be cached for anonymous users.
+    Tags may reference path arguments, such as 'blog:{id}'.
+    :param tags:
+    :return:
+    '''
+    def decorator(func):
+        func.__cache_tags__ = tags
+        return func
+    return decorator
+
+
 # ---使用inspect模块中的signature方法来获取函数的参数，实现一些复用的功能---
 # inspect.Parameter 的类型有5种：
 # POSITIONAL_ONLY           只能是位置参数
@@ -105,90 +126,233 @@ def has_request_arg(fn):
     return found
 
 
-# RequestHandler目的就是从URL处理函数（如handlers.index）中分析其需要接收的参数，从web.request对象中获取必要的参数，
-# 调用URL处理函数，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
-class RequestHandler(object):
-
-    def __init__(self, app, fn):
-        self._app = app
-        self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
-
-    # 1.定义kw对象，用于保存参数
-    # 2.判断URL处理函数是否存在参数，如果存在则判断，根据是POST还是GET方法将request请求内容保存到kw
-    # 3.如果kw为空（说明request没有请求内容），则将math_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    async def __call__(self, request):
-        kw = None
-        # 如果有需要处理的参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Tpe: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    '''
-                    # 解析URL中？后面的键值对内容保存到request_content
-                    qs = 'first=f,s&second=s'
-                    parse.parse_qs(qs, True).items()
-                    >>>dict([('first',['f,s']), ('second',['s'])])
-                    '''
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
+class _BadRequest(Exception):
+    def __init__(self, message):
+        super(_BadRequest, self).__init__(message)
+        self.message = message
+
+
+# 从POST的body或者GET的查询字符串中取出参数，没有参数返回None
+# multi中的参数是列表类型，保留所有的值，其他参数只取第一个值
+async def _read_params(request, multi=()):
+    if request.method == 'POST':
+        if not request.content_type:
+            raise _BadRequest('Missing Content-Type.')
+        ct = request.content_type.lower()
+        if ct.startswith('application/json'):
+            params = await request.json()
+            if not isinstance(params, dict):
+                raise _BadRequest('JSON body must be object.')
+            return params
+        if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+            params = await request.post()
+            kw = dict(**params)
+            for name in multi:
+                if name in params:
+                    kw[name] = params.getall(name)
+            return kw
+        raise _BadRequest('Unsupported Content-Tpe: %s' % request.content_type)
+    if request.method == 'GET':
+        qs = request.query_string
+        if qs:
             '''
-            # 参数为空说明没有从request对象中获取到参数，或者URL处理函数没有参数
-            def hello(request):
-                    text = '<h1>hello, %s!</h1>' % request.match_info['name']
-                    return web.Response()
-            app.router.add_route('GET', '/hello/{name}', hello)
+            # 解析URL中？后面的键值对内容保存到request_content
+            qs = 'first=f,s&second=s'
+            parse.parse_qs(qs, True).items()
+            >>>dict([('first',['f,s']), ('second',['s'])])
             '''
-            '''
-                if not self._has_var_kw_arg and not self._has_kw_arg and not self._required_kw_args:
-                # 当URL处理函数没有参数的时候，将requqest.match_info设置为空，防止调用出错
-                request_content = dict()
-            '''
-            kw = dict(**request.match_info)
+            return dict((k, v if k in multi else v[0]) for k, v in parse.parse_qs(qs, True).items())
+    return None
+
+
+_TRUE_VALUES = ('1', 'true', 'yes', 'on')
+_FALSE_VALUES = ('0', 'false', 'no', 'off', '')
+
+
+def _to_bool(v):
+    if isinstance(v, bool):
+        return v
+    s = str(v).strip().lower()
+    if s in _TRUE_VALUES:
+        return True
+    if s in _FALSE_VALUES:
+        return False
+    raise ValueError(v)
+
+
+# JSON中的2.0可以当作整数，2.7不能截断成2
+def _to_int(v):
+    if isinstance(v, bool):
+        raise TypeError(v)
+    if isinstance(v, float) and not v.is_integer():
+        raise ValueError(v)
+    return int(v)
+
+
+def _to_float(v):
+    if isinstance(v, bool):
+        raise TypeError(v)
+    return float(v)
+
+
+def _to_str(v):
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (list, dict)):
+        raise TypeError(v)
+    return str(v)
+
+
+# 根据类型注解生成转换函数，支持int、float、bool、str、list[str]（或typing.List[str]）以及dataclass
+# 返回(转换函数, 种类)，种类为'value'、'list'或者'form'（dataclass），不支持的注解返回(None, None)，参数原样传入
+def compile_converter(annotation):
+    if annotation is bool:
+        return _to_bool, 'value'
+    if annotation is int:
+        return _to_int, 'value'
+    if annotation is float:
+        return _to_float, 'value'
+    if annotation is str:
+        return _to_str, 'value'
+    origin = getattr(annotation, '__origin__', None)
+    if annotation is list or origin in (list, typing.List):
+        args = getattr(annotation, '__args__', None)
+        item = compile_converter(args[0])[0] if args else None
+        def convert(v):
+            values = v if isinstance(v, list) else [v]
+            return [item(x) for x in values] if item else list(values)
+        return convert, 'list'
+    if dataclasses is not None and isinstance(annotation, type) and dataclasses.is_dataclass(annotation):
+        return _compile_dataclass(annotation), 'form'
+    return None, None
+
+
+# dataclass从一个dict（JSON对象或者整个请求参数）构造，每个字段按照自己的类型注解转换
+def _compile_dataclass(cls):
+    hints = typing.get_type_hints(cls)
+    fields = []
+    for f in dataclasses.fields(cls):
+        required = f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING
+        fields.append((f.name, compile_converter(hints.get(f.name))[0], required))
+
+    def build(params):
+        if not isinstance(params, dict):
+            raise TypeError(params)
+        values = dict()
+        for name, convert, required in fields:
+            if name in params:
+                try:
+                    values[name] = convert(params[name]) if convert else params[name]
+                except (ValueError, TypeError):
+                    raise APIValueError(name, 'Invalid value for %s.' % name)
+            elif required:
+                raise APIValueError(name, 'Missing field: %s' % name)
+        return cls(**values)
+    return build
+
+
+# 命名关键字参数的类型注解 => 转换函数
+def get_kw_converters(fn):
+    fn = inspect.unwrap(fn)
+    try:
+        hints = typing.get_type_hints(fn)
+    except Exception:
+        hints = getattr(fn, '__annotations__', {})
+    converters = dict()
+    for name, param in inspect.signature(fn).parameters.items():
+        if param.kind == inspect.Parameter.KEYWORD_ONLY and name in hints:
+            convert, kind = compile_converter(hints[name])
+            if convert is not None:
+                converters[name] = (convert, kind)
+    return converters
+
+
+# 在注册URL处理函数的时候就分析好函数的参数，生成一个专门针对这种参数形式的binder闭包，
+# 每个请求只需要调用binder得到调用参数，不用再每次判断函数需要哪些参数
+def compile_binder(fn):
+    has_request = has_request_arg(fn)
+    has_var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    required = get_required_kw_args(fn)
+
+    if not has_var_kw and not named and not required:
+        # URL处理函数没有关键字参数，只需要路径中的参数，例如：
+        # def hello(request):
+        #     text = '<h1>hello, %s!</h1>' % request.match_info['name']
+        # app.router.add_route('GET', '/hello/{name}', hello)
+        if has_request:
+            async def bind(request):
+                kw = dict(request.match_info)
+                kw['request'] = request
+                return kw
+        else:
+            async def bind(request):
+                return dict(request.match_info)
+        return bind
+
+    # 没有**kw的时候只保留命名关键字参数
+    names = named if not has_var_kw else None
+    # 按类型注解转换参数，注解为dataclass的参数由整个请求参数构造
+    converters = get_kw_converters(fn)
+    multi = frozenset(name for name, (_, kind) in converters.items() if kind == 'list')
+    forms = tuple((name, convert) for name, (convert, kind) in converters.items() if kind == 'form')
+    values = tuple((name, convert) for name, (convert, kind) in converters.items() if kind != 'form')
+
+    async def bind(request):
+        params = await _read_params(request, multi)
+        if params is None:
+            # 参数为空说明没有从request对象中获取到参数
+            kw = dict(request.match_info)
         else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    # 需要理解清楚的时候才不会出错
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
+            if names is not None:
+                kw = dict((name, params[name]) for name in names if name in params)
+            else:
+                kw = params
             # check named arg: 检查关键字参数的名字是否和match_info中的重复
             for k, v in request.match_info.items():
                 if k in kw:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kw[k] = v
-        if self._has_request_arg:
+        for name, build in forms:
+            kw[name] = build(params or {})
+        # 在调用URL处理函数之前检查参数类型，不合法的参数直接返回错误，不会访问数据库
+        for name, convert in values:
+            if name in kw:
+                try:
+                    kw[name] = convert(kw[name])
+                except (ValueError, TypeError):
+                    raise APIValueError(name, 'Invalid value for %s.' % name)
+        if has_request:
             kw['request'] = request
         # check required kw: 检查是否有必须关键字参数
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        # 以上代码均是为了获取调用参数
-        logging.info('call with args: %s' % str(kw))
+        for name in required:
+            if name not in kw:
+                raise _BadRequest('Missing argument: %s' % name)
+        return kw
+    return bind
+
+
+# RequestHandler目的就是从URL处理函数（如handlers.index）中分析其需要接收的参数，从web.request对象中获取必要的参数，
+# 调用URL处理函数，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
+class RequestHandler(object):
+
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self._bind = compile_binder(fn)
+        # @cached声明的缓存tag，整页缓存的中间件根据它判断页面是否可以缓存
+        self.cache_tags = getattr(fn, '__cache_tags__', None)
+
+    async def __call__(self, request):
+        try:
+            kw = await self._bind(request)
+        except _BadRequest as e:
+            return web.HTTPBadRequest(text=e.message)
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+        # 参数可能很大，只有这条日志确实要输出时才转换成字符串
+        if _log.isEnabledFor(logging.INFO):
+            _log.info('call %s with args: %s', self._func.__name__, kw)
         try:
             r = await self._func(**kw)
             return r
@@ -7,15 +7,17 @@ __author__ = 'Toohoo Lee'
 
 'url handlers'
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, base64, asyncio
 
-from coroweb import get, post
+from collections import OrderedDict
+
+from coroweb import get, post, cached
 
 from models import User, Comment, Blog, next_id
 
-import markdown2
+import orm, render, serializer, pagecache, conditional, metrics
 from aiohttp import web
-from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page
+from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page, CursorPage
 
 from models import User, Comment, Blog, next_id
 from config import configs
@@ -23,6 +25,18 @@ from config import configs
 COOKIE_NAME = 'myblogsession'
 _COOKIE_KEY = configs.session.secret
 
+# 已经验证过的cookie缓存起来，避免每个请求都查询一次数据库
+# cookie => (user, 缓存到期时间)，按LRU淘汰
+_session_cache = OrderedDict()
+_SESSION_CACHE_TTL = configs.session.cache_ttl
+_SESSION_CACHE_SIZE = configs.session.cache_size
+
+# 博客页面每页显示的评论数
+_COMMENTS_PAGE_SIZE = 20
+
+# 正文达到这么多字符的博客页面分块输出
+_STREAM_THRESHOLD = configs.render.stream_threshold
+
 _RE_EMAIL = re.compile(r'^[0-9a-z\.\_\-]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -30,18 +44,6 @@ def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
 
-# 获取当前页页码, 供下面调用
-def get_page_index(page_str):
-    p = 1
-    try:
-        p = int(page_str)
-    except ValueError as e:
-        pass
-    if p < 1:
-        p = 1
-    return p
-
-
 # 计算加密cookie：
 def user2cookie(user, max_age):
     """
@@ -55,6 +57,12 @@ def user2cookie(user, max_age):
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
+# 接口返回的博客不带渲染好的正文HTML，列表接口每篇都带上会让响应变得很大，只有博客页面需要它
+def blogs2api(blogs):
+    for b in blogs:
+        b.pop('html_content', None)
+    return blogs
+
 def text2html(text):
     # HTML 转义字符
     # “             &quot;
@@ -74,6 +82,14 @@ async def cookie2user(cookie_str):
     """
     if not cookie_str:
         return None
+    cached = _session_cache.get(cookie_str)
+    if cached is not None:
+        user, expires = cached
+        if expires > time.time():
+            _session_cache.move_to_end(cookie_str)
+            # 返回副本，请求处理过程中修改user不会影响缓存
+            return User(**user)
+        del _session_cache[cookie_str]
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -89,29 +105,38 @@ async def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        # 缓存的时间不能超过cookie本身的有效期
+        _session_cache[cookie_str] = (User(**user), min(time.time() + _SESSION_CACHE_TTL, int(expires)))
+        if len(_session_cache) > _SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
 
+def invalidate_session(cookie_str):
+    _session_cache.pop(cookie_str, None)
+
+
 @get('/')
-async def index(*, page='1'):
+@cached('blogs')
+async def index(*, page: int = 1):
     # summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     # blogs = [
     #     Blog(id='1', name='Test Blog', summary=summary, created_at=time.time()-120),
     #     Blog(id='2', name='Something New', summary=summary, created_at=time.time()-3600),
     #     Blog(id='3', name='Learn Swift', summary=summary, created_at=time.time()-7200),
     # ]
-    page_index = get_page_index(page)
-    # 查找博客表里面的条目数
-    num = await Blog.findNumber('count(id)')
+    # page已经由coroweb按照类型注解转换成int，不合法的页码在这之前就被拒绝了
+    # 查找博客表里面的条目数，使用缓存的行数，不用每次都count一遍
+    num = await Blog.count()
     # 没有条目则不显示
     if not num or num == 0:
         logging.info('the type of num is :%s' % type(num))
         blogs = []
     else:
-        page = Page(num, page_index)
+        page = Page(num, page)
         # 根据计算出来的offset（取到的初始条目数index）和limit（取到的条数），来取出条目
         # 首页只是显示5篇文章
         blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
@@ -178,7 +203,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = "******"
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 @get('/signout')
@@ -187,6 +212,8 @@ def signout(request):
     referer = request.headers.get('Referer')
     # 赋值给r
     r = web.HTTPFound(referer or '/')
+    # 退出之后这个cookie的登录状态也不能再从缓存中取到
+    invalidate_session(request.cookies.get(COOKIE_NAME))
     # 清理掉cookie来退出账户
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
     logging.info('user signed out.')
@@ -198,20 +225,26 @@ def signout(request):
 # -------------------------------管理用户---------------------------------------------
 # 用户列表页面，未测试
 @get('/manage/users')
-def manage_users(*, page='1'):
+def manage_users(*, page: int = 1):
     return {
         '__template__': 'manage_users.html',
-        'page_index': get_page_index(page)
+        'page_index': max(page, 1)
     }
 
 # 获取用户，获取后端数据库的数据API
 @get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    # count是MySQL中的聚集函数，用于计算某列的行数
+async def api_get_users(*, page: int = 1, cursor=None):
+    # 带上cursor参数（第一页传空字符串）就使用游标分页，返回next_cursor用来取下一页
+    if cursor is not None:
+        p = CursorPage(cursor)
+        users = p.trim(await User.findAll(limit=p.limit, after=p.after))
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users, next_cursor=p.next_cursor)
+    # User.count()返回缓存的用户数，由save/remove维护，并定期和数据库中的count核对
     # user_count 代表有多少个用户id
-    user_count = await User.findNumber('count(id)')
-    p = Page(user_count, page_index)
+    user_count = await User.count()
+    p = Page(user_count, page)
     # 通过Page类来计算当前页的相关信息，其实是数据库limit语句中的offset, limit
     if user_count == 0:
         return dict(page=p, users=())
@@ -252,7 +285,7 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 
@@ -270,25 +303,38 @@ async def show_all_users():
 # -------------------------------管理博客---------------------------------------------
 # 获取到博客并转成HTML
 @get('/blog/{id}')
-async def get_blog(id):
+@cached('blog:{id}')
+async def get_blog(id, request, *, cursor=''):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # 博客和评论都没有变化，客户端缓存的页面仍然有效，不用再查评论和渲染
+    if conditional.is_fresh(request, modified=blog.updated_at):
+        return conditional.set_last_modified(conditional.not_modified(), blog.updated_at)
+    # 评论按页加载，每页_COMMENTS_PAGE_SIZE条，cursor指向上一页最后一条评论
+    p = CursorPage(cursor, page_size=_COMMENTS_PAGE_SIZE)
+    comments = p.trim(await blog.related('comments', limit=p.limit, after=p.after))
     # text直接转成HTML
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    # 正文在保存时已经渲染好了，只有渲染器版本过期的旧数据才需要重新渲染（在渲染进程池中）
+    blog.html_content = await render.blog2html(blog)
     return {
         '__template__': 'blog.html',
         "blog": blog,
-        'comments': comments
+        'comments': comments,
+        'comments_page': p,
+        '__last_modified__': blog.updated_at,
+        # 很长的正文整个页面分块输出，模板边渲染边发送
+        '__stream__': len(blog.content) >= _STREAM_THRESHOLD
     }
 
 
 @get('/manage/blogs')
-def manage_blogs(*, page='1'):
+def manage_blogs(*, page: int = 1):
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': max(page, 1)
     }
 
 
@@ -303,24 +349,31 @@ def manage_create_blog():
 
 # 后台提供博客信息
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    # 获取页面首页
-    page_index = get_page_index(page)
+@cached('blogs')
+async def api_blogs(*, page: int = 1, cursor=None):
+    # 游标分页，翻到很深的页也不用limit offset扫描前面的行
+    if cursor is not None:
+        p = CursorPage(cursor)
+        blogs = blogs2api(p.trim(await Blog.findAll(limit=p.limit, after=p.after)))
+        return dict(page=p, blogs=blogs, next_cursor=p.next_cursor)
     # 获取总的博客数目
-    blogs_count = await Blog.findNumber('count(id)')
+    blogs_count = await Blog.count()
     # 对博客进行分页
-    p = Page(blogs_count, page_index)
+    p = Page(blogs_count, page)
     if blogs_count == 0:
         return dict(page=p, blogs=())
     # 分页完成之后将博客查询出来
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = blogs2api(await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit)))
     return dict(page=p, blogs=blogs)
 
 
 # 请求具体的某条博客：插入某条博客之后马上调用这个方法回显
 @get('/api/blogs/{id}')
+@cached('blog:{id}')
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
+    if blog is not None:
+        blogs2api([blog])
     return blog
 
 
@@ -335,10 +388,15 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('summary', 'summary cannot be empty.')
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
-    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image,
+    blog = Blog(id=next_id(), user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image,
                 name=name.strip(), summary=summary.strip(), content=content.strip())
+    # 保存的时候就把正文渲染成HTML
+    await render.render_blog(blog)
     await blog.save()
+    render.invalidate_blog(blog.id)
+    pagecache.invalidate('blogs')
     # 返回一个dict， 没有模板， 会把信息直接显示出来
+    blogs2api([blog])
     return blog
 
 
@@ -356,14 +414,42 @@ async def api_modify_blog(request, *, id, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
 
+    previous = blog.content
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.updated_at = time.time()
+    # 只改了一部分的长文章，没有改动的块直接用上次渲染的结果
+    await render.render_blog(blog, previous)
 
     await blog.update()
+    render.invalidate_blog(blog.id)
+    pagecache.invalidate('blogs', 'blog:%s' % blog.id)
+    blogs2api([blog])
     return blog
 
 
+# 博客正文HTML缓存、块缓存、整页缓存的命中情况以及渲染进程池的排队和耗时，用来调整缓存和进程池的大小
+@get('/api/render/stats')
+def api_render_stats(request):
+    check_admin(request)
+    return dict(cache=render.cache_stats(), pool=render.pool_stats(), blocks=render.block_stats(),
+                page_cache=pagecache.cache_stats())
+
+
+# 数据库连接池的使用情况：连接数、获取连接的等待时间以及重连次数
+@get('/api/db/stats')
+def api_db_stats(request):
+    check_admin(request)
+    return orm.pool_stats()
+
+
+# Prometheus抓取的指标：每个路由的耗时、数据库和渲染耗时；不需要登录，由nginx限制只能从内网访问
+@get('/metrics')
+def api_metrics():
+    return web.Response(body=metrics.exposition().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
 # 管理修改博客，需要传入参数id
 @get('/manage/blogs/modify/{id}')
 def manage_modify_blog(*, id):
@@ -384,6 +470,8 @@ async def api_delete_blog(id, request):
     if b is None:
         raise APIResourceNotFoundError('Blog')
     await b.remove()
+    render.invalidate_blog(id)
+    pagecache.invalidate('blogs', 'blog:%s' % id)
     return dict(id=id)
 
 
@@ -398,20 +486,22 @@ async def manage():
 
 # 管理评论
 @get('/manage/comments')
-async def manage_comments(*, page='1'):
+async def manage_comments(*, page: int = 1):
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'page_index': max(page, 1)
     }
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    # 获取起始页码
-    page_index = get_page_index(page)
+async def api_comments(*, page: int = 1, cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        comments = p.trim(await Comment.findAll(limit=p.limit, after=p.after))
+        return dict(page=p, comments=comments, next_cursor=p.next_cursor)
     # 查询出来有多少条评论
-    num = await Comment.findNumber('count(id)')
+    num = await Comment.count()
     # 总页数和当前页，获得页码
-    p = Page(num, page_index)
+    p = Page(num, page)
     if num == 0:
         return dict(page=p, comments=())
     comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
@@ -432,8 +522,14 @@ async def api_create_comment(id, request, *, content):
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name,
                       user_image=user.image, content=content.strip())
     await comment.save()
+    await touch_blog(blog.id)
+    pagecache.invalidate('blog:%s' % blog.id)
     return comment
 
+# 评论也显示在博客页面上，评论有变化就更新博客的修改时间，只更新这一列，不用写回整篇正文
+async def touch_blog(blog_id):
+    await orm.execute('update `blogs` set `updated_at`=? where `id`=?', [time.time(), blog_id])
+
 # 删除评论
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
@@ -444,4 +540,6 @@ async def api_delete_comments(id, request):
     if comment is None:
         raise APIResourceNotFoundError('comment')
     await comment.remove()
+    await touch_blog(comment.blog_id)
+    pagecache.invalidate('blog:%s' % comment.blog_id)
     return dict(id=id)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Logging setup: records go through a queue and are formatted and written by a background thread.
+'''
+
+import sys, copy, json, time, atexit, random, logging, contextvars, logging.handlers
+
+from queue import SimpleQueue
+
+from config import configs
+
+# 每个请求都会输出的几类日志，按configs.logging.levels分别设置级别，并且按请求采样
+REQUEST = 'myblog.request'
+HANDLER = 'myblog.handler'
+SQL = 'myblog.sql'
+SAMPLED = (REQUEST, HANDLER, SQL)
+
+TEXT_FORMAT = '[%(asctime)s] %(name)s:%(levelname)s: %(message)s'
+
+# 当前请求的日志是否输出；不在请求中的日志（启动、后台任务）都输出
+_sampled = contextvars.ContextVar('log_sampled', default=True)
+_sample_rate = 1.0
+
+# LogRecord自带的属性，其余的属性都是通过extra=传入的结构化字段
+_RECORD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+_listener = None
+
+
+# 每条日志输出为一行JSON，extra=中传入的字段原样输出
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        d = dict(time='%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)), record.msecs),
+                 level=record.levelname, logger=record.name, pid=record.process, message=record.getMessage())
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRS:
+                d[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d, ensure_ascii=False, default=str)
+
+
+# 调用方只拼好消息（参数在这之后可能被修改），异常堆栈单独保存下来，格式化成JSON放到后台线程
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    _formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# 没有被采样到的请求，它的INFO及以下的日志都丢掉，WARNING以上总是输出
+def _sample_filter(record):
+    return record.levelno >= logging.WARNING or _sampled.get()
+
+
+# 没有被采样到的请求中，isEnabledFor直接返回False，连LogRecord都不用创建
+class _SampledLogger(logging.Logger):
+
+    def isEnabledFor(self, level):
+        return (level >= logging.WARNING or _sampled.get()) and super().isEnabledFor(level)
+
+
+# 在其他模块getLogger之前先用_SampledLogger创建这几个logger
+_logger_class = logging.getLoggerClass()
+logging.setLoggerClass(_SampledLogger)
+for _name in SAMPLED:
+    logging.getLogger(_name)
+logging.setLoggerClass(_logger_class)
+
+
+def sample_request():
+    ' decide whether the log lines of the current request are kept. '
+    _sampled.set(_sample_rate >= 1.0 or random.random() < _sample_rate)
+
+
+def _stream_handler():
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if configs.logging.format == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def _set_root_handler(handler):
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(configs.logging.level)
+
+
+# 调用方只把日志放进队列，格式化和写文件都在QueueListener的线程中进行，不会阻塞事件循环
+def setup():
+    global _listener, _sample_rate
+    if _listener is not None:
+        return
+    conf = configs.logging
+    handler = _stream_handler()
+    queue = SimpleQueue()
+    _set_root_handler(_QueueHandler(queue))
+    for name, level in conf.levels.items():
+        logging.getLogger(name).setLevel(level)
+    _sample_rate = conf.request_sample_rate
+    for name in SAMPLED:
+        logging.getLogger(name).addFilter(_sample_filter)
+    _listener = logging.handlers.QueueListener(queue, handler, respect_handler_level=True)
+    _listener.start()
+    # 退出之前把队列中剩下的日志写完
+    atexit.register(_listener.stop)
+
+
+# 进程池工作进程的initializer：fork出来的子进程继承了_QueueHandler，但是子进程中没有QueueListener的线程，
+# 放进队列的日志都会丢掉，所以工作进程中直接写stderr
+def setup_worker():
+    global _listener
+    _listener = None
+    _set_root_handler(_stream_handler())
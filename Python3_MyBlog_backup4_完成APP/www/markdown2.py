@@ -84,15 +84,15 @@ __author__ = "Trent Mick"
 
 import os
 import sys
+import copy
 from pprint import pprint, pformat
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
+import hashlib
+import threading
+from collections import OrderedDict
 import optparse
-from random import random, randint
+from random import random
 import codecs
 
 
@@ -132,13 +132,17 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+# Text that is stashed away during conversion (HTML blocks, escaped
+# characters, code) is replaced by a placeholder: a number unique within the
+# conversion between two private-use code points, e.g. "\ue00012\ue001".
+# The same text always gets the same placeholder. See
+# `Markdown._hash_text()`.
+_hash_open, _hash_close = "\ue000", "\ue001"
+_hash_re = re.compile("%s[0-9]+%s" % (_hash_open, _hash_close))
+_hash_chars_re = re.compile("[%s%s]" % (_hash_open, _hash_close))
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Characters that can be backslash-escaped:
+g_escape_chars = '\\`*_{}[]()>#+-.!'
 
 
 
@@ -154,22 +158,24 @@ class MarkdownError(Exception):
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
-                  use_file_vars=False):
+                  use_file_vars=False, engine="regex"):
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    engine=engine).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
+             use_file_vars=False, engine="regex"):
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    engine=engine).convert(text)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -193,7 +199,8 @@ class Markdown(object):
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 engine="regex"):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -208,6 +215,15 @@ class Markdown(object):
         else:
             self.safe_mode = safe_mode
 
+        # "regex": run each block-level transformation over the whole
+        # document (the classic Markdown.pl approach).
+        # "tokenizer": split the document into top-level blocks in one pass
+        # and render them one at a time. See `_tokenize_blocks()`.
+        if engine not in ("regex", "tokenizer"):
+            raise MarkdownError("invalid value for 'engine': %r (must be "
+                                "'regex' or 'tokenizer')" % engine)
+        self.engine = engine
+
         # Massaging and building the "extras" info.
         if self.extras is None:
             self.extras = {}
@@ -226,10 +242,17 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        # The escape table is the same in every conversion: its placeholders
+        # are the first ones made (see `reset()`).
+        self._hash_count = 0
+        self._hash_keys = {}
+        self._instance_unescape_table = {}
+        self._escape_table = dict([(ch, self._hash_text(ch, self._instance_unescape_table))
+                                   for ch in g_escape_chars])
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._escape_table['"'] = self._hash_text('"', self._instance_unescape_table)
+            self._escape_table["'"] = self._hash_text("'", self._instance_unescape_table)
+        self._instance_hash_keys = self._hash_keys
 
     def reset(self):
         self.urls = {}
@@ -238,6 +261,12 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        # Placeholders swapped back in by `_unescape_special_chars()`, and the
+        # ones for private-use code points found in the input.
+        self._hash_count = len(self._instance_unescape_table)
+        self._hash_keys = self._instance_hash_keys.copy()
+        self._unescape_table = self._instance_unescape_table.copy()
+        self._hash_chars = {}
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -246,23 +275,114 @@ class Markdown(object):
         if "metadata" in self.extras:
             self.metadata = {}
 
+    def _hash_text(self, s, table):
+        """Stash `s` away in `table` and return its placeholder.
+
+        Placeholders are numbered in order within a conversion: they are
+        short, cheap to make, and swapped back in a single regex pass (see
+        `_unhash()`). Like the hashes they replace, they only depend on the
+        text: a duplicate (e.g. the same HTML block twice) gets the same
+        placeholder, which the block-level code relies on.
+        """
+        key = self._hash_keys.get(s)
+        if key is None:
+            self._hash_count += 1
+            key = "%s%d%s" % (_hash_open, self._hash_count, _hash_close)
+            self._hash_keys[s] = key
+        table[key] = s
+        return key
+
+    def _unhash(self, text, table):
+        """Swap the placeholders in `table` back into `text`."""
+        if _hash_open not in text:
+            return text
+        def _unhash_sub(match):
+            return table.get(match.group(0), match.group(0))
+        return _hash_re.sub(_unhash_sub, text)
+
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
     _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
 
-    def convert(self, text):
-        """Convert the given text."""
-        # Main function. The order in which other subs are called here is
-        # essential. Link and image substitutions need to happen before
-        # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
-        # and <img> tags get encoded.
+    # Per-conversion settings, see `convert()`.
+    _block_cache = None
+    _max_uncached = None
+    # Reference link ids looked up while rendering a block for the cache.
+    _link_ids = None
 
+    def convert(self, text, block_cache=None, max_uncached=None):
+        """Convert the given text.
+
+        The converter itself is not modified: the state of the conversion
+        is kept in a context (see `_context()`). One instance can be reused
+        for any number of documents, also from several threads at once.
+
+        With the "tokenizer" engine, `block_cache` (a `BlockCache`) keeps
+        the HTML of top-level blocks between conversions, so that only new
+        or changed blocks are rendered. If `max_uncached` is given and more
+        characters than that would have to be rendered, nothing is and None
+        is returned.
+        """
+        context = self._context()
+        context._block_cache = block_cache
+        context._max_uncached = max_uncached
+        return context._convert(text)
+
+    def convert_iter(self, text, block_cache=None):
+        """Convert the given text, yielding the HTML as it is rendered:
+        joined together, the pieces are what `convert()` returns.
+
+        With the "tokenizer" engine there is a piece for every top-level
+        block, yielded as soon as the link definitions are collected. Other
+        documents are converted whole and come as a single piece. The pieces
+        are plain strings, `postprocess()` is called on each of them.
+        """
+        context = self._context()
+        context._block_cache = block_cache
+        text = context._prepare(text)
+        if not (context.engine == "tokenizer" and context._can_tokenize(text)):
+            yield context._finish(context._run_block_gamut(text))
+            return
+        sep = ""
+        for html in context._iter_blocks(text, context._tokenize_blocks(text)):
+            yield context._finish_html(sep + html)
+            sep = "\n\n"
+        yield "\n"
+
+    def _context(self):
+        """Return a context for one conversion: a shallow copy of this
+        converter that shares its configuration, with fresh state.
+        """
+        context = copy.copy(self)
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
         # articles):
-        self.reset()
+        context.reset()
+        return context
+
+    def _convert(self, text):
+        # Main function. The order in which other subs are called here is
+        # essential. Link and image substitutions need to happen before
+        # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
+        # and <img> tags get encoded.
+        text = self._prepare(text)
 
+        if self.engine == "tokenizer" and self._can_tokenize(text):
+            text = self._emit_blocks(text, self._tokenize_blocks(text))
+            if text is None:
+                return None
+        elif self._max_uncached is not None and len(text) > self._max_uncached:
+            return None
+        else:
+            text = self._run_block_gamut(text)
+
+        return self._finish(text)
+
+    def _prepare(self, text):
+        """Everything before the block gamut: normalize the text, hash the
+        raw HTML blocks and collect the link definitions.
+        """
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
@@ -286,6 +406,13 @@ class Markdown(object):
         # Standardize line endings:
         text = re.sub("\r\n|\r", "\n", text)
 
+        # Placeholders are made of private-use code points, so any of those
+        # in the input are stashed away too: the text can't forge one.
+        if _hash_chars_re.search(text):
+            keys = dict([(ch, self._hash_text(ch, self._hash_chars))
+                         for ch in (_hash_open, _hash_close)])
+            text = _hash_chars_re.sub(lambda m: keys[m.group(0)], text)
+
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
 
@@ -322,13 +449,22 @@ class Markdown(object):
             # looks like a link defn:
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
-        text = self._strip_link_definitions(text)
-
-        text = self._run_block_gamut(text)
+        return self._strip_link_definitions(text)
 
+    def _finish(self, text):
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
 
+        text = self._finish_html(text) + "\n"
+
+        rv = UnicodeWithAttrs(text)
+        if "toc" in self.extras:
+            rv._toc = self._toc
+        if "metadata" in self.extras:
+            rv.metadata = self.metadata
+        return rv
+
+    def _finish_html(self, text):
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
@@ -339,14 +475,9 @@ class Markdown(object):
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
 
-        text += "\n"
-
-        rv = UnicodeWithAttrs(text)
-        if "toc" in self.extras:
-            rv._toc = self._toc
-        if "metadata" in self.extras:
-            rv.metadata = self.metadata
-        return rv
+        if self._hash_chars:
+            text = self._unhash(text, self._hash_chars)
+        return text
 
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
@@ -577,15 +708,12 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
-                self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
-                self.html_blocks[l_key] = last_line
+                f_key = self._hash_text(first_line, self.html_blocks)
+                l_key = self._hash_text(last_line, self.html_blocks)
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
-        self.html_blocks[key] = html
+        key = self._hash_text(html, self.html_blocks)
         return "\n\n" + key + "\n\n"
 
     def _hash_html_blocks(self, text, raw=False):
@@ -677,9 +805,11 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
-                self.html_blocks[key] = html
+                key = self._hash_text(html, self.html_blocks)
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                # Carry on after the placeholder: it isn't as long as the
+                # comment, so `start` from above would skip some text.
+                start = start_idx + len(key) + 4
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -773,6 +903,19 @@ class Markdown(object):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
 
+        text = self._run_block_elements(text)
+
+        # We already ran _HashHTMLBlocks() before, in Markdown(), but that
+        # was to escape raw HTML in the original Markdown source. This time,
+        # we're escaping the markup we've just created, so that we don't wrap
+        # <p> tags around block-level tags.
+        text = self._hash_html_blocks(text)
+
+        text = self._form_paragraphs(text)
+
+        return text
+
+    def _run_block_elements(self, text):
         if "fenced-code-blocks" in self.extras:
             text = self._do_fenced_code_blocks(text)
 
@@ -799,15 +942,328 @@ class Markdown(object):
 
         text = self._do_block_quotes(text)
 
-        # We already ran _HashHTMLBlocks() before, in Markdown(), but that
-        # was to escape raw HTML in the original Markdown source. This time,
-        # we're escaping the markup we've just created, so that we don't wrap
-        # <p> tags around block-level tags.
+        return text
+
+    # ---- "tokenizer" engine
+    #
+    # The regex engine above runs every block-level transformation over the
+    # whole document, one after the other. The tokenizer engine makes a
+    # single pass over the top-level blocks (runs of non-blank lines) and
+    # builds a flat list of `(kind, value)` nodes:
+    #
+    #   ("p", text)       paragraph
+    #   ("h", match)      atx or setext header (a `_h_re` match)
+    #   ("hr", None)      horizontal rule
+    #   ("code", text)    indented code block, possibly spanning blank lines
+    #   ("html", key)     block-level HTML hashed by `_hash_html_blocks()`
+    #   ("raw", text)     anything else, rendered by `_run_block_gamut()`
+    #
+    # Lists, block quotes and other blocks whose meaning depends on the
+    # blocks around them are kept together in "raw" nodes, so the output is
+    # identical to the regex engine's. A new node is only started where none
+    # of the whole-document regexes could match across the boundary.
+
+    # Extras that only affect span-level output, or that the emitter handles.
+    # Anything else (footnote numbering, header ids, tables, ...) depends on
+    # the document-wide processing order and falls back to the regex engine.
+    _tokenizer_extras = frozenset(["code-friendly", "nofollow", "smarty-pants",
+        "break-on-newline", "link-patterns", "html-classes", "demote-headers"])
+
+    _tok_block_re = re.compile(r'[^\n]+(?:\n[^\n]+)*')
+    _tok_special_line_re = re.compile(r'''
+        ^(?:
+            [ \t]*[#>]                          # atx header, block quote
+            |
+            (?:=+|-+)[ \t]*$                    # setext header underline
+            |
+            [ ]{0,3}(?:[-_*][ ]{0,2}){3,}$      # horizontal rule
+        )
+        ''', re.M | re.X)
+    _tok_marker_re = re.compile(r'[ \t]*(?:[*+-]|\d+\.)[ \t]')
+    # A list item with no text: the list regex needs at least one more
+    # character, so the list runs on into the next block.
+    _tok_empty_item_re = re.compile(r'^[ \t]*(?:[*+-]|\d+\.)[ \t]+\Z', re.M)
+    _tok_unindented_re = re.compile(r'^(?![ ]{4})', re.M)
+    # Raw block-level HTML that `_hash_html_blocks()` could match from this
+    # block into the following ones.
+    _tok_html_open_re = re.compile(r'^[ \t]*<(?:%s|hr)\b|<!--' % _block_tags_a,
+                                   re.M)
+    _tok_html_close_re = re.compile(r'^</(?:%s)\b' % _block_tags_a, re.M)
+
+    def _can_tokenize(self, text):
+        if self.safe_mode or not self._tokenizer_extras.issuperset(self.extras):
+            return False
+        # A closing block tag at the start of a line can end a block-level
+        # HTML match started anywhere before it, and the code block regex
+        # looks ahead for "</code>" through the rest of the document.
+        return ("</code>" not in text
+                and self._tok_html_close_re.search(text) is None)
+
+    def _tok_classify(self, block):
+        """Return the node kind of a single top-level block, or None if it
+        needs the full block gamut.
+        """
+        if block in self.html_blocks:
+            return "html"
+        if block.startswith("    "):
+            if self._tok_unindented_re.search(block) is None:
+                return "code"
+            return None
+        if "\n" not in block:
+            if self._hr_re.match(block):
+                return "hr"
+            if block[0] == "#":
+                match = self._h_re.match(block + "\n")
+                if match and match.end() == len(block) + 1:
+                    return "h"
+                return None
+        elif block.count("\n") == 1 and block[block.index("\n") + 1] in "=-":
+            match = self._h_re.match(block + "\n")
+            if match and match.end() == len(block) + 1:
+                return "h"
+            return None
+        if (self._tok_special_line_re.search(block) is None
+                and not self._tok_marker_re.match(block)):
+            return "p"
+        return None
+
+    def _tok_starts_node(self, prev, block):
+        """Can `block` start a new node after a node of kind `prev`?"""
+        if prev == "code":
+            # An indented block continues the code block.
+            return not block.startswith("    ")
+        if prev == "raw":
+            # Lists, code blocks and block quotes end at the first block
+            # that starts at the left margin with something else.
+            return (block[0] not in " \t>"
+                    and not (self._tok_marker_re.match(block)
+                             and not self._hr_re.match(block)))
+        # Paragraphs, headers, rules and HTML never extend past a blank line.
+        return True
+
+    def _tokenize_blocks(self, text):
+        """Split the text into a list of `(kind, value)` nodes."""
+        nodes = []
+        kind = start = end = None
+        # Set once a block could be matched by `_hash_html_blocks()` together
+        # with the blocks after it: everything from there on is one node.
+        sticky = False
+        pending_sticky = False
+        hold = False
+        for match in self._tok_block_re.finditer(text):
+            block = match.group(0)
+            block_kind = self._tok_classify(block)
+            block_sticky = ("<" in block
+                            and self._tok_html_open_re.search(block) is not None)
+            if block_sticky and block_kind != "code":
+                block_kind = None
+            if kind is not None and (sticky or hold or not self._tok_starts_node(kind, block)):
+                # Extend the current node.
+                if kind != "code" or block_kind != "code":
+                    kind = "raw"
+                end = match.end()
+            else:
+                if kind is not None:
+                    nodes.append(self._tok_node(text, kind, start, end, match.start()))
+                kind, start, end = block_kind or "raw", match.start(), match.end()
+                pending_sticky = False
+            # HTML inside an indented code block is harmless, unless the
+            # block turns out to be part of something else (e.g. a list).
+            if block_sticky:
+                pending_sticky = True
+            if pending_sticky and kind != "code":
+                sticky = True
+            hold = (block[-1] in " \t"
+                    and self._tok_empty_item_re.search(block) is not None)
+        if kind is not None:
+            nodes.append(self._tok_node(text, kind, start, end, len(text)))
+        if nodes and nodes[0][0] == "raw" and nodes[0][1]:
+            # At the start of the document the block-level HTML regexes
+            # take in a leading newline (`\A\n?`): keep it in the node.
+            nodes[0] = ("raw", 0, text[:nodes[0][1]] + nodes[0][2])
+        return nodes
+
+    def _tok_node(self, text, kind, start, end, next_start):
+        if kind == "raw":
+            # Keep the trailing blank lines, as the block gamut would see them.
+            value = text[start:next_start]
+        elif kind == "h":
+            value = self._h_re.match(text[start:end] + "\n")
+        elif kind == "hr":
+            value = None
+        else:
+            value = text[start:end]
+        return kind, start, value
+
+    # Generated tags whose closing tag can start a line (`_strict_tag_block_re`).
+    _tok_strict_open_re = re.compile(r'^<(?:blockquote|ul|ol)\b', re.M)
+    _tok_unhashed_re = re.compile(r'^<(?:%s)\b' % _block_tags_a, re.M)
+
+    def _tok_block_gamut(self, text):
+        """`_run_block_gamut()` for a "raw" node. Returns None if a block-level
+        tag was left open, e.g. a block quote at the end of a list item: the
+        regex engine's document-wide `_hash_html_blocks()` could match it with
+        a closing tag from a later node.
+        """
+        text = self._run_block_elements(text)
+        if self._tok_strict_open_re.search(self._strict_tag_block_re.sub("", text)):
+            return None
         text = self._hash_html_blocks(text)
+        if self._tok_unhashed_re.search(text):
+            return None
+        return self._form_paragraphs(text)
 
-        text = self._form_paragraphs(text)
+    def _emit_blocks(self, text, nodes):
+        blocks = self._iter_blocks(text, nodes)
+        if blocks is None:
+            return None
+        return "\n\n".join(blocks)
 
-        return text
+    def _iter_blocks(self, text, nodes):
+        """Return an iterator over the HTML of the nodes (the ones that
+        render to nothing are left out), or None if more than `_max_uncached`
+        characters would have to be rendered.
+        """
+        if self._block_cache is not None and nodes:
+            plan = self._plan_cached_blocks(text, nodes)
+            if plan is None:
+                return None
+            return self._emit_cached_blocks(text, plan)
+        if self._max_uncached is not None and len(text) > self._max_uncached:
+            return None
+        if not nodes:
+            return filter(None, [self._run_block_gamut(text)])
+        return self._emit_uncached_blocks(text, nodes)
+
+    def _emit_uncached_blocks(self, text, nodes):
+        for kind, start, value in nodes:
+            html = self._emit_node(kind, value)
+            if html is None:
+                # Render the rest of the document in one go.
+                yield self._run_block_gamut(text[start:])
+                break
+            if html:
+                yield html
+
+    def _emit_node(self, kind, value):
+        """Return the HTML of one node, or None if a "raw" node has to be
+        rendered together with the rest of the document.
+        """
+        if kind == "p":
+            # As in `_form_paragraphs()`.
+            return "<p>" + self._run_span_gamut(value).lstrip(" \t") + "</p>"
+        elif kind == "h":
+            return self._h_sub(value)[:-2]
+        elif kind == "hr":
+            return "<hr" + self.empty_element_suffix
+        elif kind == "code":
+            # As in `_code_block_sub()`.
+            codeblock = self._detab(self._outdent(value)).lstrip('\n').rstrip()
+            return "<pre%s><code%s>%s\n</code></pre>" % (
+                self._html_class_str_from_tag("pre"),
+                self._html_class_str_from_tag("code"),
+                self._encode_code(codeblock))
+        elif kind == "html":
+            return self.html_blocks[value]
+        elif kind == "rest":
+            return self._run_block_gamut(value)
+        return self._tok_block_gamut(value)
+
+    # Block cache
+    #
+    # A cache entry is the finished HTML of a node (placeholders swapped back
+    # in), keyed by a hash of the converter's settings and the node's source.
+    # It also records the reference links the node looked up, with their
+    # definitions at the time: those can be anywhere in the document, and the
+    # entry is only used while they are unchanged. A "raw" node that had to be
+    # rendered with the rest of the document (see `_emit_node()`) is cached
+    # as None, and the rest of the document as a "rest" node.
+
+    def _block_source(self, kind, value):
+        if kind == "h":
+            return value.group(0)
+        # Placeholders of raw HTML blocks are numbered in document order:
+        # key on the HTML itself.
+        return self._unhash(value, self.html_blocks)
+
+    _block_settings = None
+    def _block_key(self, kind, source):
+        if self._block_settings is None:
+            self._block_settings = repr((self.__class__.__name__,
+                self.empty_element_suffix, self.tab_width,
+                sorted(self.extras.items()), self.link_patterns))
+        return hashlib.sha1("\0".join([self._block_settings, kind, source])
+                            .encode("utf-8")).digest()
+
+    def _links_unchanged(self, entry):
+        for link_id, url, title in entry[1]:
+            if self.urls.get(link_id) != url or self.titles.get(link_id) != title:
+                return False
+        return True
+
+    def _cached_node(self, kind, value):
+        source = self._block_source(kind, value)
+        key = self._block_key(kind, source)
+        return (key, len(source),
+                self._block_cache.get(key, valid=self._links_unchanged))
+
+    def _render_node(self, kind, value):
+        """Render a node for the cache. Returns its HTML (None as in
+        `_emit_node()`) and its reference link dependencies.
+        """
+        self._link_ids = set()
+        try:
+            html = self._emit_node(kind, value)
+            if html is not None:
+                html = self._unescape_special_chars(html)
+            links = tuple([(link_id, self.urls.get(link_id), self.titles.get(link_id))
+                           for link_id in sorted(self._link_ids)])
+        finally:
+            self._link_ids = None
+        return html, links
+
+    def _plan_cached_blocks(self, text, nodes):
+        # Look up every node first, to know how much is left to render.
+        plan = []
+        uncached = 0
+        for kind, start, value in nodes:
+            if kind in ("hr", "html"):
+                plan.append((kind, start, value, None, None))
+                continue
+            key, size, entry = self._cached_node(kind, value)
+            if entry is not None and entry[0] is None:
+                kind, value = "rest", text[start:]
+                key, size, entry = self._cached_node(kind, value)
+            if entry is None:
+                uncached += size
+            plan.append((kind, start, value, key, entry))
+            if kind == "rest":
+                break
+        if self._max_uncached is not None and uncached > self._max_uncached:
+            return None
+        return plan
+
+    def _emit_cached_blocks(self, text, plan):
+        for kind, start, value, key, entry in plan:
+            if key is None:
+                html = self._emit_node(kind, value)
+            elif entry is not None:
+                html = entry[0]
+            else:
+                html, links = self._render_node(kind, value)
+                self._block_cache.put(key, (html, links))
+                if html is None:
+                    kind, value = "rest", text[start:]
+                    key, size, entry = self._cached_node(kind, value)
+                    if entry is not None:
+                        html = entry[0]
+                    else:
+                        html, links = self._render_node(kind, value)
+                        self._block_cache.put(key, (html, links))
+            if html:
+                yield html
+            if kind == "rest":
+                break
 
     def _pyshell_block_sub(self, match):
         lines = match.group(0).splitlines(0)
@@ -1026,18 +1482,14 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
-                self.html_spans[key] = sanitized
-                tokens.append(key)
+                tokens.append(self._hash_text(sanitized, self.html_spans))
             else:
                 tokens.append(token)
             is_html_markup = not is_html_markup
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1254,6 +1706,8 @@ class Markdown(object):
                     link_id = match.group("id").lower()
                     if not link_id:
                         link_id = link_text.lower()  # for links like [this][]
+                    if self._link_ids is not None:
+                        self._link_ids.add(link_id)
                     if link_id in self.urls:
                         url = self.urls[link_id]
                         # We've got to encode these to avoid conflicting
@@ -1571,8 +2025,7 @@ class Markdown(object):
 
         if lexer_name:
             def unhash_code( codeblock ):
-                for key, sanitized in list(self.html_spans.items()):
-                    codeblock = codeblock.replace(key, sanitized)
+                codeblock = self._unhash(codeblock, self.html_spans)
                 replacements = [
                     ("&amp;", "&"),
                     ("&lt;", "<"),
@@ -1704,9 +2157,7 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
-        return hashed
+        return self._hash_text(text, self._unescape_table)
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
@@ -1868,8 +2319,10 @@ class Markdown(object):
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
     _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    # A placeholder next to the bracket is part of a tag, e.g. an escaped
+    # '"' ending an attribute value.
+    _naked_lt_re = re.compile(r'<(?![a-z/?\$!%s])' % _hash_open, re.I)
+    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"%s-])>''' % _hash_close, re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -1886,6 +2339,8 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
+        if "\\" not in text:
+            return text
         for ch, escape in list(self._escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
@@ -1899,12 +2354,12 @@ class Markdown(object):
           <
            (?:mailto:)?
           (
-              [-.\w]+
+              [-.\w%(hash)s]+
               \@
-              [-\w]+(\.[-\w]+)*\.[a-z]+
+              [-\w%(hash)s]+(\.[-\w%(hash)s]+)*\.[a-z]+
           )
           >
-        """, re.I | re.X | re.U)
+        """ % {"hash": _hash_open + _hash_close}, re.I | re.X | re.U)
     def _auto_email_link_sub(self, match):
         return self._encode_email_address(
             self._unescape_special_chars(match.group(1)))
@@ -1957,18 +2412,23 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
-                link_from_hash[hash] = link
+                hash = self._hash_text(link, link_from_hash)
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return self._unhash(text, link_from_hash)
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        if _hash_open not in text:
+            return text
+        return _hash_re.sub(self._unescape_sub, text)
+
+    def _unescape_sub(self, match):
+        text = self._unescape_table.get(match.group(0))
+        if text is None:
+            # Not one of ours, e.g. an HTML span in safe mode.
+            return match.group(0)
+        # Code can contain placeholders of its own.
+        return self._unescape_special_chars(text)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -1988,6 +2448,56 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class BlockCache(object):
+    """A cache of rendered top-level blocks for `Markdown.convert()` with
+    the "tokenizer" engine: after an edit, only the blocks that changed
+    are rendered again.
+
+    Beyond `max_entries` the least recently used entries are dropped. One
+    cache can be shared by threads and by converters with different
+    settings.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, valid=None):
+        """Return the entry for `key`, or None if there is none or
+        `valid(entry)` is false.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if valid is None or valid(entry):
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def items(self):
+        """All entries, e.g. to hand them to a cache in another process."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def update(self, items):
+        for key, entry in items:
+            self.put(key, entry)
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -2304,12 +2814,16 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("--engine", choices=["regex", "tokenizer"],
+                      help="block-level engine: 'regex' (default) or "
+                           "'tokenizer'")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
     parser.set_defaults(log_level=logging.INFO, compare=False,
-                        encoding="utf-8", safe_mode=None, use_file_vars=False)
+                        encoding="utf-8", safe_mode=None, use_file_vars=False,
+                        engine="regex")
     opts, paths = parser.parse_args()
     log.setLevel(opts.log_level)
 
@@ -2381,7 +2895,8 @@ def main(argv=None):
             html4tags=opts.html4tags,
             safe_mode=opts.safe_mode,
             extras=extras, link_patterns=link_patterns,
-            use_file_vars=opts.use_file_vars)
+            use_file_vars=opts.use_file_vars,
+            engine=opts.engine)
         if py3:
             sys.stdout.write(html)
         else:
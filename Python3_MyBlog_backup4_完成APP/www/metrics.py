@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Request, database and rendering timings, exported in the Prometheus text format.
+'''
+
+import contextvars
+
+# 直方图的上界，单位是秒，最后还有一个+Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+
+# prefork.py多进程部署时每个工作进程的指标是分开的，所有样本都带上worker标签（工作进程的槽位号）
+_worker = None
+
+
+def set_worker(worker):
+    global _worker
+    _worker = None if worker is None else str(worker)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(names, values)]
+    if _worker is not None:
+        pairs.insert(0, 'worker="%s"' % _escape(_worker))
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # 标签值的tuple => 计数
+        self._values = dict()
+        _metrics.append(self)
+
+    def inc(self, labels=(), value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, labels), value)
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # 标签值的tuple => [每个桶的计数..., +Inf的计数, 总和]
+        self._values = dict()
+        _metrics.append(self)
+
+    def observe(self, value, labels=()):
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self._values.items()):
+            # Prometheus的桶是累积的：le="x"表示小于等于x的个数
+            total = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts[:-1]):
+                total += n
+                yield '%s_bucket%s %s' % (self.name, _labels(self.labels, labels, 'le="%s"' % bound), total)
+            yield '%s_sum%s %s' % (self.name, _labels(self.labels, labels), counts[-1])
+            yield '%s_count%s %s' % (self.name, _labels(self.labels, labels), total)
+
+
+request_duration = Histogram('myblog_http_request_duration_seconds', 'Request latency by route.', ('method', 'route'))
+responses = Counter('myblog_http_responses_total', 'Responses by route and status.', ('method', 'route', 'status'))
+request_db_duration = Histogram('myblog_request_db_seconds', 'Database time spent per request by route.', ('route',))
+request_db_queries = Counter('myblog_request_db_queries_total', 'Database queries issued by route.', ('route',))
+db_duration = Histogram('myblog_db_query_duration_seconds', 'Duration of single queries.', ('op',))
+render_duration = Histogram('myblog_render_duration_seconds', 'Markdown and template rendering time.', ('kind',))
+
+
+# 一个请求中各部分花费的时间，通过contextvar传递，查询数据库和渲染的地方不用拿到request对象
+class RequestTiming(object):
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.markdown_time = 0.0
+        self.template_time = 0.0
+
+    def server_timing(self, total):
+        ' value of the Server-Timing response header, durations in milliseconds. '
+        return 'db;dur=%.2f;desc="%s queries", markdown;dur=%.2f, template;dur=%.2f, total;dur=%.2f' % (
+            self.db_time * 1000, self.db_queries, self.markdown_time * 1000, self.template_time * 1000, total * 1000)
+
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+
+def start_request():
+    timing = RequestTiming()
+    _current.set(timing)
+    return timing
+
+
+def observe_db(op, seconds):
+    db_duration.observe(seconds, (op,))
+    timing = _current.get()
+    if timing is not None:
+        timing.db_time += seconds
+        timing.db_queries += 1
+
+
+def observe_render(kind, seconds):
+    render_duration.observe(seconds, (kind,))
+    timing = _current.get()
+    if timing is not None:
+        if kind == 'markdown':
+            timing.markdown_time += seconds
+        else:
+            timing.template_time += seconds
+
+
+def finish_request(method, route, status, seconds, timing):
+    request_duration.observe(seconds, (method, route))
+    responses.inc((method, route, str(status)))
+    request_db_duration.observe(timing.db_time, (route,))
+    if timing.db_queries:
+        request_db_queries.inc((route,), timing.db_queries)
+
+
+def exposition():
+    ' all metrics in the Prometheus text exposition format. '
+    lines = []
+    for m in _metrics:
+        lines.append('# HELP %s %s' % (m.name, m.help))
+        lines.append('# TYPE %s %s' % (m.name, m.type))
+        lines.extend(m.samples())
+    return '\n'.join(lines) + '\n'
@@ -9,7 +9,7 @@ __author__ = 'Toohoo lee'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, HasMany
 
 # 主键id的缺省值是函数next_id，创建时间created_at的缺省值是函数time.time，可以自动设置当前日期和时间。
 # 生成唯一的标识符号
@@ -41,7 +41,14 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    # 保存文章时就渲染好的HTML，renderer记录渲染器的版本，版本不一致的行需要重新渲染
+    html_content = TextField(default='')
+    renderer = StringField(ddl='varchar(50)', default='')
     created_at = FloatField(default=time.time)
+    # 博客页面最后修改的时间：修改正文或者增删评论时更新，用作Last-Modified
+    updated_at = FloatField(default=time.time)
+    # 博客的评论，通过Blog.find(id, prefetch=['comments'])或者blog.related('comments')加载
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc, id desc')
 
 
 class Comment(Model):
@@ -3,14 +3,72 @@
 
 __author__ = 'Toohoo'
 
-import asyncio, logging
+import asyncio, logging, functools, time, weakref
+
+from contextlib import asynccontextmanager
 
 import aiomysql
 
+import metrics
+
+# 每个Model缓存的SQL语句条数上限，where子句一般都是代码里写死的，正常情况下远远用不完
+_MAX_CACHED_QUERIES = 256
+
 
-# 打印出SQL语句
+# SQL日志单独一类，默认级别是WARNING，需要时在configs.logging.levels中打开
+_log = logging.getLogger('myblog.sql')
+
+
+# 打印出SQL语句，日志级别没有打开时不拼接字符串
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    _log.info('SQL: %s', sql)
+
+
+# 连接池的统计信息：获取连接的等待时间（包括直方图）以及重连次数
+class PoolStats(object):
+    # 等待时间直方图的上界，单位是秒，最后一个桶是+Inf
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_counts = [0] * (len(self.buckets) + 1)
+        self.opened = 0
+        self.initial_size = 0
+        self.peak_size = 0
+        # 已经见过的连接，新出现的连接说明连接池新建了一个连接
+        self._seen = weakref.WeakSet()
+
+    def start(self, pool):
+        for conn in getattr(pool, '_free', ()):
+            self._seen.add(conn)
+        self.initial_size = self.peak_size = pool.size
+
+    def acquired(self, pool, conn, wait):
+        self.acquires += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        for i, bound in enumerate(self.buckets):
+            if wait <= bound:
+                self.wait_counts[i] += 1
+                break
+        else:
+            self.wait_counts[-1] += 1
+        if conn not in self._seen:
+            self._seen.add(conn)
+            self.opened += 1
+        if pool.size > self.peak_size:
+            self.peak_size = pool.size
+
+    @property
+    def reconnects(self):
+        # 新建的连接要么让连接池变大，要么是替换掉已经关闭（超时回收或者断开）的连接，后者就是重连
+        return max(0, self.opened - (self.peak_size - self.initial_size))
+
+
+_stats = PoolStats()
 
 
 # 创建数据库连接池
@@ -27,33 +85,70 @@ async def create_pool(loop, **kw):
         autocommit=kw.get('autocommit', True),
         maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
+        # 连接空闲超过pool_recycle秒之后重新建立，避免被MySQL的wait_timeout断开，-1表示不回收
+        pool_recycle=kw.get('pool_recycle', -1),
 
         # 接收一个event_loop实例
         loop=loop
     )
+    _stats.start(__pool)
+
+
+# 关闭连接池：等待借出去的连接归还之后关闭所有连接
+async def close_pool():
+    logging.info('close database connection pool...')
+    __pool.close()
+    await __pool.wait_closed()
+
+
+# 从连接池获取一个连接，用完之后自动放回连接池，同时记录获取连接的等待时间
+@asynccontextmanager
+async def _connection():
+    started = time.monotonic()
+    conn = await __pool.acquire()
+    _stats.acquired(__pool, conn, time.monotonic() - started)
+    try:
+        yield conn
+    finally:
+        __pool.release(conn)
+
+
+def pool_stats():
+    ' statistics of the connection pool. '
+    histogram = dict(zip([str(b) for b in PoolStats.buckets] + ['+Inf'], _stats.wait_counts))
+    return dict(size=__pool.size, freesize=__pool.freesize, minsize=__pool.minsize, maxsize=__pool.maxsize,
+                acquires=_stats.acquires, wait_total=_stats.wait_total, wait_max=_stats.wait_max,
+                wait_avg=_stats.wait_total / _stats.acquires if _stats.acquires else 0.0,
+                wait_histogram=histogram, opened=_stats.opened, reconnects=_stats.reconnects)
+
+
+# 把SQL中的占位符'?'替换成驱动使用的'%s'，结果缓存起来，同一条SQL只替换一次
+# 已经替换过的SQL中没有'?'，再次传入得到的还是同一条SQL
+@functools.lru_cache(maxsize=1024)
+def to_driver_sql(sql):
+    return sql.replace('?', '%s')
 
 
 # 封装select语句成为select函数
 async def select(sql, args, size=None):
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        # DictCursor是一个返回字典的游标
-        try:
+    started = time.monotonic()
+    try:
+        # 连接用完之后放回连接池复用，不能关闭，否则每次查询都要重新建立连接
+        async with _connection() as conn:
+            # DictCursor是一个返回字典的游标
             async with conn.cursor(aiomysql.DictCursor) as cur:
                 # 替换占位符，执行SQL语句
-                await cur.execute(sql.replace('?', '%s'), args or ())
+                await cur.execute(to_driver_sql(sql), args or ())
                 if size:
                     rs = await cur.fetchmany(size)
                 else:
                     rs = await cur.fetchall()
-        except BaseException:
-            raise
-        finally:
-            # 最后一定要关闭数据库连接
-            conn.close()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    finally:
+        # 查询次数和耗时（包括等待连接的时间）记到当前请求上
+        metrics.observe_db('select', time.monotonic() - started)
+    _log.debug('rows returned: %s', len(rs))
+    return rs
 
 
 # 封装insert， update， delete语句，
@@ -61,20 +156,48 @@ async def select(sql, args, size=None):
 # 返回操作影响的行 execute只返回结果数，不返回结果集
 async def execute(sql, args, autocommit=True):
     log(sql)
-    async with __pool.get() as conn:
-        if not autocommit:
-            await conn.begin()
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
+    started = time.monotonic()
+    try:
+        async with _connection() as conn:
             if not autocommit:
+                await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(to_driver_sql(sql), args)
+                    affected = cur.rowcount
+                if not autocommit:
+                    await conn.commit()
+            except BaseException as e:
+                if not autocommit:
+                    await conn.rollback()
+                raise
+    finally:
+        metrics.observe_db('execute', time.monotonic() - started)
+    return affected
+
+
+# 批量执行同一条insert/update语句，所有批次都在同一个事务里面，出错就整体回滚
+# insert语句交给executemany之后会被驱动改写成一条多行values的语句，每批只需要一次往返
+async def execute_many(sql, args_list, batch_size=500):
+    log(sql)
+    affected = 0
+    started = time.monotonic()
+    try:
+        async with _connection() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    sql = to_driver_sql(sql)
+                    for i in range(0, len(args_list), batch_size):
+                        await cur.executemany(sql, args_list[i:i + batch_size])
+                        affected += cur.rowcount
                 await conn.commit()
-        except BaseException as e:
-            if not autocommit:
+            except BaseException:
                 await conn.rollback()
-            raise
-        return affected
+                raise
+    finally:
+        metrics.observe_db('execute_many', time.monotonic() - started)
+    return affected
 
 
 # 更具参数数量生成SQL占位符‘？’列表。
@@ -132,6 +255,23 @@ class TextField(Field):
         super().__init__(name, 'text', False, default)
 
 
+# 一对多关系，例如一篇博客有多条评论：comments = HasMany('Comment', 'blog_id')
+# model可以写成类名字符串，用到的时候再从已经定义的Model中查找，避免模型之间互相引用的问题
+class HasMany(object):
+
+    def __init__(self, model, foreign_key, orderBy=None):
+        self.model = model
+        self.foreign_key = foreign_key
+        self.orderBy = orderBy
+
+    def target(self):
+        return _models[self.model] if isinstance(self.model, str) else self.model
+
+
+# 类名 => Model子类，供HasMany查找关联的模型
+_models = dict()
+
+
 # 定义Model的元类
 # 注意到Model只是一个基类，如何将具体的子类如User的映射信息读取出来呢？答案就是通过metaclass：ModelMetaclass
 # 所有的元素都继承自type， ModelMetaclass元类定义了所有的Model基础类（继承ModelMetaclass）的子类实现的操作
@@ -160,11 +300,14 @@ class ModelMetaclass(type):
 
         # 获取Field和主键名
         mappings = dict()
+        relations = dict()
         fields = []
         primaryKey = None
         for k, v in attrs.items():
+            if isinstance(v, HasMany):
+                relations[k] = v
             # Field属性
-            if isinstance(v, Field):
+            elif isinstance(v, Field):
                 # 此处打印的k是类的一个属性， v是这个属性在数据库中对应的Field列表属性
                 logging.info('  found mapping: %s ==> %s' % (k, v))
                 mappings[k] = v
@@ -180,6 +323,8 @@ class ModelMetaclass(type):
         # 从类属性中删除Field属性，实例的属性会遮盖类的同名属性
         for k in mappings.keys():
             attrs.pop(k)
+        for k in relations.keys():
+            attrs.pop(k)
         # 保存除主键外的属性名为``（运算出字符串）列表的形式
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         attrs['__mappings__'] = mappings # 保存属性和列的映射关系
@@ -187,6 +332,7 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
         attrs['__fields__'] = fields # 除主键外的属性名
+        attrs['__relations__'] = relations # 关系名 => HasMany
         # 构造默认的SELECT、INSERT、UPDATE、DELETE语句
         # ``反引号的功能同repr（）
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
@@ -197,7 +343,13 @@ class ModelMetaclass(type):
             'update `%s` set %s where `%s`=?' % \
             (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = to_driver_sql('%s where `%s`=?' % (attrs['__select__'], primaryKey))
+        # 编译好的查询缓存：(where, orderBy, limit的形式) => 可以直接交给驱动执行的SQL
+        attrs['__queries__'] = {}
+        # 行数缓存：value为缓存的行数，checked为上一次和数据库核对的时间
+        attrs['__counter__'] = dict(value=None, checked=0)
+        _models[name] = type.__new__(cls, name, bases, attrs)
+        return _models[name]
 
 
 # 定义ORM所有的映射的基类：Model
@@ -208,6 +360,11 @@ class ModelMetaclass(type):
 # Model从dict继承，拥有字典的所有功能，同时实现特殊方法__getattr__和__setattr__, 能够实现属性操作
 # 实现数据库操作的所有方法，定义为class方法，所继承自Model都具有数据库操作方法
 class Model(dict, metaclass=ModelMetaclass):
+    # 行数缓存多少秒之后和数据库重新核对一次；
+    # 表很大的时候可以把__count_estimate__设为True，使用information_schema中的估计值代替count
+    __count_ttl__ = 300
+    __count_estimate__ = False
+
     # 继承了字典，所以可以接受任意属性，实例取到的是字典的值
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -236,58 +393,147 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def _cache_query(cls, key, sql):
+        sql = to_driver_sql(' '.join(sql))
+        if len(cls.__queries__) < _MAX_CACHED_QUERIES:
+            cls.__queries__[key] = sql
+        return sql
+
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
         if args is None:
             args = []
-        # 语句中是否有OrderBy参数
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        # 语句中是否有limit参数
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        # after=(created_at, id)：游标分页，从上一页最后一条记录之后开始取，不再使用offset
+        # 按(created_at, 主键)倒序，可以直接利用created_at上的索引定位，不需要扫描再丢弃前面的行
+        # 传入了after就是游标分页，第一页after=None也要按这个顺序，否则created_at相同的行在两页之间会重复或者漏掉
+        seek = 'after' in kw
+        after = kw.get('after', None)
+        if seek:
+            orderBy = 'created_at desc, `%s` desc' % cls.__primary_key__
+        if after is not None:
+            args.extend([after[0], after[0], after[1]])
+        # limit只有三种形式：没有limit，limit ?，limit ?, ?
+        if limit is None:
+            shape = 0
+        elif isinstance(limit, int):
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        key = ('all', where, orderBy, shape, after is not None)
+        sql = cls.__queries__.get(key)
+        if sql is None:
+            sql = [cls.__select__]
+            conditions = []
+            if where:
+                conditions.append('(%s)' % where if after is not None else where)
+            if after is not None:
+                conditions.append('(`created_at`<? or (`created_at`=? and `%s`<?))' % cls.__primary_key__)
+            if conditions:
+                sql.append('where')
+                sql.append(' and '.join(conditions))
+            # 语句中是否有OrderBy参数
+            if orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            # 语句中是否有limit参数
+            if shape == 1:
+                sql.append('limit ?')
+            elif shape == 2:
+                sql.append('limit ?, ?')
+            sql = cls._cache_query(key, sql)
+        rs = await select(sql, args)
+        objs = [cls(**r) for r in rs]
+        prefetch = kw.get('prefetch', None)
+        if prefetch:
+            await cls.prefetch(objs, prefetch)
+        return objs
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
-        # 这里的_num_为别名，任何客户端都可以按照这个名称引用这个列，就好像它是个实际的列一样
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        key = ('number', selectField, where)
+        sql = cls.__queries__.get(key)
+        if sql is None:
+            # 这里的_num_为别名，任何客户端都可以按照这个名称引用这个列，就好像它是个实际的列一样
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            sql = cls._cache_query(key, sql)
+        rs = await select(sql, args, 1)
         if len(rs) == 0:
             return None
         # rs[0]表示一行数据，是一个字典，而rs是一个列表
         return rs[0]['_num_']
 
     @classmethod
-    async def find(cls, pk):
+    async def count(cls):
+        ' count rows with a cache maintained by save/remove and reconciled periodically. '
+        counter = cls.__counter__
+        now = time.time()
+        if counter['value'] is None or now - counter['checked'] > cls.__count_ttl__:
+            if cls.__count_estimate__:
+                rs = await select('select table_rows _num_ from information_schema.tables '
+                                  'where table_schema=database() and table_name=?', [cls.__table__], 1)
+                value = int(rs[0]['_num_']) if rs else 0
+            else:
+                value = await cls.findNumber('count(`%s`)' % cls.__primary_key__)
+            counter['value'] = value or 0
+            counter['checked'] = now
+        return counter['value']
+
+    @classmethod
+    def _count_changed(cls, delta):
+        # 还没有缓存过行数就不用维护，等第一次count的时候再查
+        if cls.__counter__['value'] is not None:
+            cls.__counter__['value'] = max(0, cls.__counter__['value'] + delta)
+
+    @classmethod
+    async def find(cls, pk, prefetch=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select(cls.__find__, [pk], 1)
         if len(rs) == 0:
             return None
         # 1.将rs[0]转换成为关键字参数元祖，rs[0]为dict
         # 2.通过<class '__main__.User'>(位置参数元祖)，产生一个实例对象
-        return cls(**rs[0])
+        obj = cls(**rs[0])
+        if prefetch:
+            await cls.prefetch([obj], prefetch)
+        return obj
+
+    @classmethod
+    async def prefetch(cls, instances, names):
+        ' load relations of many objects, one query per relation. '
+        pks = [inst.getValue(cls.__primary_key__) for inst in instances]
+        for name in names:
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise ValueError('Relation not found: %s.%s' % (cls.__name__, name))
+            groups = dict((pk, []) for pk in pks)
+            if pks:
+                # 所有对象的关联行用一条 in (...) 查询取回来，再按外键分组，避免N+1次查询
+                where = '`%s` in (%s)' % (relation.foreign_key, create_args_string(len(groups)))
+                for obj in await relation.target().findAll(where, list(groups), orderBy=relation.orderBy):
+                    groups[obj[relation.foreign_key]].append(obj)
+            for inst, pk in zip(instances, pks):
+                inst[name] = groups[pk]
+        return instances
+
+    async def related(self, name, **kw):
+        ' load one page of a relation, accepts the limit/after arguments of findAll. '
+        relation = self.__relations__.get(name)
+        if relation is None:
+            raise ValueError('Relation not found: %s.%s' % (self.__class__.__name__, name))
+        return await relation.target().findAll('`%s`=?' % relation.foreign_key, [self.getValue(self.__primary_key__)],
+                                               orderBy=relation.orderBy, **kw)
 
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
@@ -295,6 +541,30 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning('Failed to insert record: affected rows: %s' % rows)
+        self._count_changed(rows)
+
+    @classmethod
+    async def save_many(cls, instances, batch_size=500):
+        ' insert objects in batches inside one transaction. '
+        fields = cls.__fields__ + [cls.__primary_key__]
+        args_list = [list(map(inst.getValueOrDefault, fields)) for inst in instances]
+        if not args_list:
+            return 0
+        rows = await execute_many(cls.__insert__, args_list, batch_size)
+        if rows != len(args_list):
+            logging.warning('Failed to insert records: affected rows: %s of %s' % (rows, len(args_list)))
+        cls._count_changed(rows)
+        return rows
+
+    @classmethod
+    async def update_many(cls, instances, batch_size=500):
+        ' update objects by primary key in batches inside one transaction. '
+        fields = cls.__fields__ + [cls.__primary_key__]
+        args_list = [list(map(inst.getValue, fields)) for inst in instances]
+        if not args_list:
+            return 0
+        # 内容没有变化的行不计入affected rows，所以这里不检查行数
+        return await execute_many(cls.__update__, args_list, batch_size)
 
     async def update(self):
         args = list(map(self.getValue, self.__fields__))
@@ -308,6 +578,7 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warning('Failed to remove by primary key: affected rows: %s' % rows)
+        self._count_changed(-rows)
 
 
 
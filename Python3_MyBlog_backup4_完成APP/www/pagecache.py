@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Full-page output cache for anonymous GET requests.
+'''
+
+import time, asyncio, logging
+
+from collections import OrderedDict
+
+from aiohttp import web
+
+from config import configs
+
+import conditional
+
+# 这些响应头和具体的某次响应有关，不能缓存
+_SKIP_HEADERS = ('Content-Length', 'Date', 'Set-Cookie', 'Transfer-Encoding')
+
+# 生成缓存页面的请求上的标记：后台刷新的请求不能分块输出（原来的请求已经用缓存的页面回复过了，
+# 再往同一个连接上写会多出一个响应），其他请求照常分块输出，同时把写出的各块留下来生成缓存条目
+_BUFFERED = 'pagecache.buffered'
+_CHUNKS = 'pagecache.chunks'
+# 分块输出的响应写完之后，写出的各块保存在响应的这个key下面
+_STREAMED_BODY = 'pagecache.body'
+
+
+def prepare_request(request, buffered):
+    ' mark request as one that fills the cache, a buffered one must not stream its response. '
+    if buffered:
+        request[_BUFFERED] = True
+    else:
+        request[_CHUNKS] = []
+
+
+def buffered(request):
+    ' whether the response to request has to be a complete web.Response. '
+    return request.get(_BUFFERED, False)
+
+
+def stream_collector(request):
+    ' the list to append the streamed chunks of the response to, None if they are not cached. '
+    return request.get(_CHUNKS)
+
+
+def set_streamed_body(resp, chunks):
+    ' record the chunks written to the StreamResponse resp, so that it can be cached. '
+    resp[_STREAMED_BODY] = chunks
+
+
+class _Entry(object):
+
+    def __init__(self, status, headers, body, tags, created):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.tags = tags
+        self.created = created
+
+    def response(self):
+        return web.Response(status=self.status, headers=self.headers, body=self.body)
+
+
+# 缓存渲染好的整个页面：按path + query寻址，过期时间内直接返回；
+# 过期之后stale_ttl秒内仍然先返回旧页面，同时在后台重新生成（stale-while-revalidate）；
+# 同一个页面同时只有一个请求在生成，其他请求等待它的结果，避免缓存失效的瞬间大量请求一起打到数据库
+class PageCache(object):
+
+    def __init__(self, enabled=True, ttl=10, stale_ttl=60, max_entries=1000):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # tag => 带有这个tag的key
+        self._tags = dict()
+        # 正在生成的页面：key => Future
+        self._pending = dict()
+        # 每次失效都加1，生成过程中发生了失效的页面不能写入缓存
+        self._generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, key, tags, handler):
+        ' return the cached response of key, handler(buffered) builds it on a miss. '
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.time() - entry.created
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.response()
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._pending:
+                    self.refreshes += 1
+                    asyncio.ensure_future(self._refresh(key, tags, handler))
+                return entry.response()
+        self.misses += 1
+        return await self._fill(key, tags, handler)
+
+    async def _refresh(self, key, tags, handler):
+        try:
+            await self._fill(key, tags, handler, buffered=True)
+        except Exception as e:
+            logging.warning('failed to refresh cached page %s: %s' % (key, e))
+
+    async def _fill(self, key, tags, handler, buffered=False):
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            entry = await asyncio.shield(pending)
+            if entry is not None:
+                return entry.response()
+            # 第一个请求的结果不能缓存（比如出错了），只好自己生成
+            return await handler(buffered)
+        pending = asyncio.get_event_loop().create_future()
+        self._pending[key] = pending
+        generation = self._generation
+        entry = None
+        try:
+            resp = await handler(buffered)
+            entry = self._entry_of(resp, tags)
+            if entry is not None and generation == self._generation:
+                self._put(key, entry)
+            return resp
+        finally:
+            del self._pending[key]
+            pending.set_result(entry)
+
+    # 只缓存200的完整响应，设置了cookie的响应不缓存。分块输出的StreamResponse在生成它的请求中已经写出去了，
+    # 用set_streamed_body记下的各块生成缓存条目，等待它的请求和之后的请求直接返回缓存的页面，不用再渲染一遍
+    def _entry_of(self, resp, tags):
+        if not isinstance(resp, web.StreamResponse) or resp.status != 200 or 'Set-Cookie' in resp.headers:
+            return None
+        if isinstance(resp, web.Response):
+            body = resp.body
+            if not isinstance(body, bytes):
+                return None
+            # 缓存时就算好ETag，命中的时候不用再对整个页面做hash
+            if 'ETag' not in resp.headers:
+                resp.headers['ETag'] = conditional.etag(body)
+            headers = dict((k, v) for k, v in resp.headers.items() if k not in _SKIP_HEADERS)
+        else:
+            chunks = resp.get(_STREAMED_BODY)
+            if chunks is None:
+                return None
+            body = b''.join(chunks)
+            # 响应头已经发出去了，ETag只加在缓存的副本上
+            headers = dict((k, v) for k, v in resp.headers.items() if k not in _SKIP_HEADERS)
+            headers['ETag'] = conditional.etag(body)
+        return _Entry(resp.status, headers, body, tags, time.time())
+
+    def _put(self, key, entry):
+        self._remove(key)
+        self._entries[key] = entry
+        for tag in entry.tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for tag in entry.tags:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def invalidate(self, *tags):
+        ' drop every cached page carrying one of the tags. '
+        self._generation += 1
+        self.invalidations += 1
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def stats(self):
+        return dict(entries=len(self._entries), max_entries=self.max_entries, hits=self.hits,
+                    stale_hits=self.stale_hits, misses=self.misses, coalesced=self.coalesced,
+                    refreshes=self.refreshes, evictions=self.evictions, invalidations=self.invalidations)
+
+
+_cache = PageCache(**configs.page_cache)
+
+
+def enabled():
+    return _cache.enabled
+
+
+async def get(key, tags, handler):
+    return await _cache.get(key, tags, handler)
+
+
+# 多进程部署时由prefork.py设置：把本进程的失效通知转发给其他工作进程，它们的缓存里也可能有同样的页面
+_broadcast = None
+
+
+def set_broadcast(fn):
+    global _broadcast
+    _broadcast = fn
+
+
+def invalidate(*tags):
+    _cache.invalidate(*tags)
+    if _broadcast is not None:
+        _broadcast(tags)
+
+
+# 收到其他进程转发的失效通知，只清理本进程的缓存，不再转发
+def invalidate_local(*tags):
+    _cache.invalidate(*tags)
+
+
+def cache_stats():
+    return _cache.stats()
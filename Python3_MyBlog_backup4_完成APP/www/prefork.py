@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Multi-process deployment: a master process supervising N worker processes that share the listening port.
+
+Usage:
+    python3 prefork.py          start the master and configs.server.workers workers
+    kill -HUP <master pid>      rolling restart, workers are replaced one at a time
+    kill -TERM <master pid>     graceful shutdown
+    kill -USR1 <master pid>     log the health reported by every worker
+
+Page cache invalidations are relayed by the master, so an edit handled by one worker
+also drops the cached pages of the others.
+'''
+
+import logging, logconfig;logconfig.setup()
+
+import os, sys, json, time, signal, socket, asyncio, selectors, subprocess
+
+import startup
+
+from config import configs
+
+
+# 主进程中记录的一个工作进程
+class Worker(object):
+
+    def __init__(self, slot, generation, process, fd, control_fd):
+        self.slot = slot
+        # 每次滚动重启generation加1，旧的一代进程在新进程就绪之后被停掉
+        self.generation = generation
+        self.process = process
+        self.pid = process.pid
+        # 心跳管道的读端，工作进程也通过它上报页面缓存的失效
+        self.fd = fd
+        # 控制管道的写端，主进程通过它把其他进程的缓存失效转发过来
+        self.control_fd = control_fd
+        self.started = time.time()
+        self.last_seen = self.started
+        self.ready = False
+        # 发送SIGTERM的时间，None表示没有在停止
+        self.stopping = None
+        self.killed = False
+        self.health = dict()
+        self._buffer = b''
+
+    def feed(self, data):
+        ' parse heartbeat lines, return the invalidation lines to relay to the other workers. '
+        self._buffer += data
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()
+        invalidations = []
+        for line in lines:
+            try:
+                report = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning('bad heartbeat from worker %s: %r' % (self.pid, line))
+                continue
+            if 'invalidate' in report:
+                invalidations.append(line + b'\n')
+                continue
+            self.health = report
+            self.last_seen = time.time()
+            self.ready = True
+        return invalidations
+
+    def send(self, data):
+        try:
+            os.write(self.control_fd, data)
+        except BlockingIOError:
+            logging.warning('control pipe of worker %s is full, dropping %r' % (self.pid, data))
+        except BrokenPipeError:
+            # 进程正在退出，下一轮_reap会清理它
+            pass
+
+    def signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def status(self):
+        return dict(pid=self.pid, slot=self.slot, generation=self.generation, started=self.started,
+                    last_seen=self.last_seen, ready=self.ready, stopping=self.stopping is not None,
+                    health=self.health)
+
+
+# 主进程：启动工作进程，退出了就重新启动，没有心跳就杀掉重启；
+# 收到SIGHUP时逐个槽位启动新进程，新进程就绪之后再停掉旧进程，重启期间一直有进程在接受连接
+class Master(object):
+
+    # 其他的设置（监听地址、keep-alive等）由工作进程中的startup.py使用
+    def __init__(self, workers=0, reuse_port=False, graceful_timeout=30, heartbeat=5, health_timeout=30,
+                 status_file=None, unix_socket=None, **kw):
+        self.num_workers = workers or os.cpu_count() or 1
+        # Unix domain socket不支持SO_REUSEPORT，只能由主进程监听
+        self.reuse_port = reuse_port and not unix_socket
+        self.graceful_timeout = graceful_timeout
+        self.heartbeat = heartbeat
+        self.health_timeout = health_timeout
+        self.status_file = status_file
+        self.sock = None
+        self.generation = 0
+        # pid => Worker
+        self.workers = dict()
+        # 槽位 => 最早可以重新启动的时间，启动就失败的进程不要马上反复重启
+        self._backoff = dict()
+        self._selector = selectors.DefaultSelector()
+        self._shutdown = None
+        self._last_status = 0
+
+    def run(self):
+        # 使用SO_REUSEPORT时每个工作进程自己监听，否则主进程监听之后把socket交给工作进程
+        if not self.reuse_port:
+            self.sock = startup.listen_socket()
+        signal.signal(signal.SIGHUP, lambda sig, frame: self.reload())
+        signal.signal(signal.SIGTERM, lambda sig, frame: self.shutdown())
+        signal.signal(signal.SIGINT, lambda sig, frame: self.shutdown())
+        signal.signal(signal.SIGUSR1, lambda sig, frame: self.log_health())
+        logging.info('master %s listening at %s with %s workers...'
+                     % (os.getpid(), startup.address(), self.num_workers))
+        while self._shutdown is None or self.workers:
+            for key, _ in self._selector.select(1):
+                self._read(key.data)
+            self._reap()
+            if self._shutdown is None:
+                self._maintain()
+                self._check_health()
+            else:
+                self._check_shutdown()
+            self._write_status()
+        if self.sock is not None:
+            self.sock.close()
+        logging.info('master %s exited.' % os.getpid())
+
+    def reload(self):
+        if self._shutdown is None:
+            self.generation += 1
+            logging.info('rolling restart to generation %s...' % self.generation)
+
+    def shutdown(self):
+        if self._shutdown is None:
+            self._shutdown = time.time()
+            logging.info('shutting down %s workers...' % len(self.workers))
+            for w in self.workers.values():
+                self._stop(w)
+
+    def log_health(self):
+        for w in sorted(self.workers.values(), key=lambda w: w.slot):
+            logging.info('worker %s: %s' % (w.pid, json.dumps(w.status())))
+
+    def _spawn(self, slot):
+        r, w = os.pipe()
+        cr, cw = os.pipe()
+        args = [sys.executable, os.path.abspath(__file__), 'worker', str(slot), str(w), str(cr)]
+        fds = [w, cr]
+        if self.sock is not None:
+            args.append(str(self.sock.fileno()))
+            fds.append(self.sock.fileno())
+        process = subprocess.Popen(args, pass_fds=fds, cwd=os.path.dirname(os.path.abspath(__file__)))
+        os.close(w)
+        os.close(cr)
+        os.set_blocking(r, False)
+        os.set_blocking(cw, False)
+        worker = Worker(slot, self.generation, process, r, cw)
+        self.workers[worker.pid] = worker
+        self._selector.register(r, selectors.EVENT_READ, worker)
+        logging.info('spawned worker %s for slot %s (generation %s).' % (worker.pid, slot, self.generation))
+
+    def _stop(self, worker):
+        if worker.stopping is None:
+            worker.stopping = time.time()
+            worker.signal(signal.SIGTERM)
+
+    def _read(self, worker):
+        try:
+            data = os.read(worker.fd, 65536)
+        except BlockingIOError:
+            return
+        if data:
+            for line in worker.feed(data):
+                for w in self.workers.values():
+                    if w is not worker:
+                        w.send(line)
+
+    def _reap(self):
+        for w in list(self.workers.values()):
+            code = w.process.poll()
+            if code is None:
+                continue
+            self._selector.unregister(w.fd)
+            os.close(w.fd)
+            os.close(w.control_fd)
+            del self.workers[w.pid]
+            if w.stopping is not None:
+                logging.info('worker %s stopped.' % w.pid)
+                continue
+            logging.warning('worker %s of slot %s exited unexpectedly with code %s.' % (w.pid, w.slot, code))
+            if not w.ready:
+                self._backoff[w.slot] = time.time() + self.heartbeat
+
+    def _slot(self, slot):
+        return [w for w in self.workers.values() if w.slot == slot and w.stopping is None]
+
+    def _maintain(self):
+        now = time.time()
+        # 先把没有进程的槽位补上
+        for slot in range(self.num_workers):
+            if not self._slot(slot) and now >= self._backoff.get(slot, 0):
+                self._spawn(slot)
+        # 滚动重启：一次只替换一个槽位，新进程就绪之后才停掉旧进程，旧进程退出之后才处理下一个槽位
+        for slot in range(self.num_workers):
+            workers = [w for w in self.workers.values() if w.slot == slot]
+            old = [w for w in workers if w.generation != self.generation]
+            if not old:
+                continue
+            current = [w for w in workers if w.generation == self.generation]
+            if not current:
+                if now >= self._backoff.get(slot, 0):
+                    self._spawn(slot)
+            elif current[0].ready:
+                for w in old:
+                    self._stop(w)
+            break
+
+    def _check_health(self):
+        now = time.time()
+        for w in self.workers.values():
+            if w.stopping is not None:
+                if now - w.stopping > self.graceful_timeout + self.heartbeat and not w.killed:
+                    logging.warning('worker %s did not stop in time, killing it.' % w.pid)
+                    w.killed = True
+                    w.signal(signal.SIGKILL)
+            elif now - w.last_seen > self.health_timeout and not w.killed:
+                logging.warning('worker %s sent no heartbeat for %.0fs, killing it.' % (w.pid, now - w.last_seen))
+                w.killed = True
+                w.signal(signal.SIGKILL)
+
+    def _check_shutdown(self):
+        if time.time() - self._shutdown > self.graceful_timeout + self.heartbeat:
+            for w in self.workers.values():
+                if not w.killed:
+                    logging.warning('worker %s did not stop in time, killing it.' % w.pid)
+                    w.killed = True
+                    w.signal(signal.SIGKILL)
+
+    def _write_status(self):
+        now = time.time()
+        if not self.status_file or now - self._last_status < self.heartbeat:
+            return
+        self._last_status = now
+        status = dict(pid=os.getpid(), generation=self.generation, updated=now,
+                      workers=[w.status() for w in sorted(self.workers.values(), key=lambda w: w.slot)])
+        # 先写临时文件再改名，监控程序不会读到写了一半的文件
+        tmp = '%s.tmp' % self.status_file
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(status, f)
+            os.replace(tmp, self.status_file)
+        except OSError as e:
+            logging.warning('failed to write status file %s: %s' % (self.status_file, e))
+
+
+# 工作进程：心跳中报告连接数、事件循环的延迟、数据库连接池和渲染进程池的状态
+async def heartbeat(fd, interval, server, stopped):
+    import orm, render, pagecache
+    started = time.time()
+    lag = 0.0
+    while True:
+        report = dict(pid=os.getpid(), started=started, time=time.time(), loop_lag=lag,
+                      connections=len(getattr(server, 'connections', ())), db=orm.pool_stats(),
+                      render=render.pool_stats(), page_cache=pagecache.cache_stats())
+        try:
+            os.write(fd, (json.dumps(report) + '\n').encode('utf-8'))
+        except BlockingIOError:
+            # 主进程没有及时读取，丢掉这一次心跳
+            pass
+        except BrokenPipeError:
+            # 主进程已经不在了，没有人再管理这个进程，自己退出
+            logging.warning('master is gone, worker %s stopping.' % os.getpid())
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+        before = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - before - interval
+
+
+# 工作进程中修改了博客，通过心跳管道告诉主进程，由主进程转发给其他工作进程
+def broadcast_invalidation(fd):
+    def broadcast(tags):
+        try:
+            os.write(fd, (json.dumps(dict(invalidate=list(tags))) + '\n').encode('utf-8'))
+        except BlockingIOError:
+            logging.warning('heartbeat pipe is full, other workers keep %s until the ttl expires.' % (tags,))
+        except BrokenPipeError:
+            pass
+    return broadcast
+
+
+# 读取主进程转发来的失效通知，清理本进程的页面缓存
+def listen_invalidation(loop, fd):
+    import pagecache
+    buffer = [b'']
+
+    def read():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            loop.remove_reader(fd)
+            return
+        lines = (buffer[0] + data).split(b'\n')
+        buffer[0] = lines.pop()
+        for line in lines:
+            try:
+                tags = json.loads(line.decode('utf-8'))['invalidate']
+            except (ValueError, KeyError):
+                logging.warning('bad message from master: %r' % line)
+                continue
+            pagecache.invalidate_local(*tags)
+
+    os.set_blocking(fd, False)
+    loop.add_reader(fd, read)
+
+
+# 工作进程自己的指标端口，只提供/metrics；滚动重启时新旧两个进程短暂共用端口，所以用SO_REUSEPORT
+async def start_metrics(slot):
+    import metrics
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=metrics.exposition().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(metrics_app, handle_signals=False, access_log=None)
+    await runner.setup()
+    server = configs.server
+    site = web.TCPSite(runner, server.metrics_host, server.metrics_port + slot, reuse_port=True)
+    await site.start()
+    logging.info('worker %s serving metrics at http://%s:%s/metrics' % (os.getpid(), server.metrics_host, server.metrics_port + slot))
+    return runner
+
+
+async def serve(loop, slot, heartbeat_fd, control_fd, listen_fd):
+    if listen_fd is None:
+        sock = startup.listen_socket(reuse_port=True)
+    else:
+        sock = socket.socket(fileno=listen_fd)
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+    import metrics
+    metrics.set_worker(slot)
+    # 每个工作进程都有自己的数据库连接池，只有第一个槽位的进程运行后台任务
+    runner = await startup.start(loop, sock, background=(slot == 0))
+    metrics_runner = await start_metrics(slot) if configs.server.metrics_port else None
+    import pagecache
+    pagecache.set_broadcast(broadcast_invalidation(heartbeat_fd))
+    listen_invalidation(loop, control_fd)
+    logging.info('worker %s (slot %s) started.' % (os.getpid(), slot))
+    beat = loop.create_task(heartbeat(heartbeat_fd, configs.server.heartbeat, runner.server, stopped))
+    await stopped
+    logging.info('worker %s stopping...' % os.getpid())
+    await startup.stop(runner)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    beat.cancel()
+
+
+def run_worker(slot, heartbeat_fd, control_fd, listen_fd=None):
+    # 由主进程负责处理Ctrl-C和SIGHUP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    os.set_blocking(heartbeat_fd, False)
+    loop = startup.new_event_loop()
+    loop.run_until_complete(serve(loop, slot, heartbeat_fd, control_fd, listen_fd))
+    loop.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']:
+        args = [int(a) for a in sys.argv[2:]]
+        run_worker(*args)
+    else:
+        Master(**configs.server).run()
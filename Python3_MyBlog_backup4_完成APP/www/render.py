@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Markdown rendering with a content-addressed HTML cache and a process pool.
+'''
+
+import os, sys, time, hashlib, logging, asyncio
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2
+
+import orm, metrics, logconfig
+
+from apis import APIError
+from config import configs
+from models import Blog
+
+# 渲染器版本，保存在Blog.renderer中；升级markdown2之后版本改变，旧的行会在后台重新渲染
+RENDERER = 'markdown2-%s' % markdown2.__version__
+
+
+# 转换器在导入时创建一次，convert不会修改它，可以一直复用；进程池的工作进程导入时也各自创建一个
+_converter = markdown2.Markdown(engine=configs.render.engine)
+
+# 主进程中各个顶层块的渲染结果，连同它引用的链接定义；修改文章时没有改动的块直接从这里取
+_blocks = markdown2.BlockCache(**configs.render.blocks)
+
+
+# 模块级函数，交给进程池执行：渲染的同时把每个块的结果带回主进程，放进主进程的块缓存
+def _markdown_blocks(text):
+    blocks = markdown2.BlockCache(max_entries=sys.maxsize)
+    return _converter.convert(text, block_cache=blocks), blocks.items()
+
+
+# 博客正文的HTML缓存：按 blog id + 正文内容的hash 来寻址
+# 正文没有变化时直接返回上一次渲染好的HTML，正文改变之后hash不同，自然不会命中旧的结果
+# 内存中使用LRU淘汰，同时可以选择把渲染结果落盘，重启之后不必全部重新渲染
+class RenderCache(object):
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        # blog_id => (digest, html)，OrderedDict的顺序就是最近使用的顺序
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, blog_id, digest):
+        return os.path.join(self.path, '%s-%s.html' % (blog_id, digest))
+
+    def get(self, blog_id, digest):
+        entry = self._entries.get(blog_id)
+        if entry is not None and entry[0] == digest:
+            self._entries.move_to_end(blog_id)
+            self.hits += 1
+            return entry[1]
+        if self.path:
+            try:
+                with open(self._file(blog_id, digest), 'r', encoding='utf-8') as f:
+                    html = f.read()
+            except OSError:
+                pass
+            else:
+                self.disk_hits += 1
+                self._store(blog_id, digest, html)
+                return html
+        self.misses += 1
+        return None
+
+    def put(self, blog_id, digest, html):
+        self._store(blog_id, digest, html)
+        if self.path:
+            # 先写临时文件再改名，避免其他进程读到写了一半的文件
+            fn = self._file(blog_id, digest)
+            tmp = '%s.%s.tmp' % (fn, os.getpid())
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(html)
+                os.replace(tmp, fn)
+            except OSError as e:
+                logging.warning('failed to persist rendered html %s: %s' % (fn, e))
+
+    def _store(self, blog_id, digest, html):
+        old = self._entries.pop(blog_id, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        self._entries[blog_id] = (digest, html)
+        self._bytes += len(html)
+        # 超出条目数或者内存上限就从最久没有使用的一端开始淘汰
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, blog_id):
+        old = self._entries.pop(blog_id, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        self.invalidations += 1
+        if self.path:
+            prefix = '%s-' % blog_id
+            for fn in os.listdir(self.path):
+                if fn.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.path, fn))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        return dict(entries=len(self._entries), bytes=self._bytes, max_entries=self.max_entries,
+                    max_bytes=self.max_bytes, hits=self.hits, misses=self.misses, disk_hits=self.disk_hits,
+                    evictions=self.evictions, invalidations=self.invalidations)
+
+
+_cache = RenderCache(**configs.render.cache)
+
+
+# markdown2是纯Python的正则替换，长文章直接在事件循环里渲染会卡住所有连接，
+# 所以超过一定长度的文章交给进程池去渲染，短文章仍然在当前进程内渲染，省掉进程间传输的开销。
+# 进程中的任务无法取消，渲染超时之后整个进程池会被替换掉：旧的工作进程直接杀掉，
+# 否则几篇渲染不完的文章就能占满所有工作进程，后面的文章都只能排队等到超时
+class RenderPool(object):
+
+    def __init__(self, workers=2, inline_threshold=4096, timeout=10):
+        self.workers = workers
+        self.inline_threshold = inline_threshold
+        self.timeout = timeout
+        self._executor = None
+        # 统计信息：排队中的任务数，渲染次数以及耗时
+        self.pending = 0
+        self.max_pending = 0
+        self.inline_renders = 0
+        self.pool_renders = 0
+        self.timeouts = 0
+        self.recycles = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def start(self):
+        if self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=logconfig.setup_worker)
+            logging.info('start markdown render pool with %s workers...' % self.workers)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    # 杀掉executor的工作进程，换一个新的进程池；只有还在使用的那个进程池才替换，
+    # 同一批进程上的多个任务一起超时时不会把刚换上的新进程池也杀掉
+    def _recycle(self, executor):
+        if executor is not self._executor:
+            return
+        self._executor = None
+        self.start()
+        self.recycles += 1
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+        logging.warning('markdown render pool recycled.')
+
+    async def _submit(self, text):
+        executor = self._executor
+        loop = asyncio.get_event_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(executor, _markdown_blocks, text), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.warning('markdown rendering timed out after %ss (%s chars)' % (self.timeout, len(text)))
+            self._recycle(executor)
+            raise APIError('render:timeout', 'content', 'Rendering timed out.')
+        except BrokenProcessPool:
+            # 工作进程意外退出或者被_recycle杀掉，换上新的进程池之后再交给调用方决定是否重试
+            self._recycle(executor)
+            raise
+
+    def _record(self, started):
+        cost = time.monotonic() - started
+        self.total_time += cost
+        if cost > self.max_time:
+            self.max_time = cost
+        metrics.observe_render('markdown', cost)
+
+    # incremental表示这篇文章上一个版本的各个块在块缓存中（比如修改时只改了一段），
+    # 要渲染的不超过inline_threshold个字符就在当前进程增量渲染。
+    # 判断要渲染多少字符也要先切分整篇文章，长文章要十几到上百毫秒，所以不知道有缓存的长文章直接交给进程池
+    async def render(self, text, incremental=False):
+        started = time.monotonic()
+        html = None
+        if self._executor is None or len(text) < self.inline_threshold:
+            html = _converter.convert(text, block_cache=_blocks)
+        elif incremental:
+            html = _converter.convert(text, block_cache=_blocks, max_uncached=self.inline_threshold)
+        if html is not None:
+            self.inline_renders += 1
+            self._record(started)
+            return html
+        self.pending += 1
+        if self.pending > self.max_pending:
+            self.max_pending = self.pending
+        try:
+            try:
+                html, blocks = await self._submit(text)
+            except BrokenProcessPool:
+                # 同一个进程池里其他文章渲染超时，进程池被替换，这篇跟着被中止了，在新的进程池中再渲染一次
+                html, blocks = await self._submit(text)
+        finally:
+            self.pending -= 1
+        _blocks.update(blocks)
+        self.pool_renders += 1
+        self._record(started)
+        return html
+
+    def stats(self):
+        renders = self.inline_renders + self.pool_renders
+        return dict(workers=self.workers if self._executor else 0, pending=self.pending, max_pending=self.max_pending,
+                    inline_renders=self.inline_renders, pool_renders=self.pool_renders, timeouts=self.timeouts,
+                    recycles=self.recycles,
+                    avg_time=self.total_time / renders if renders else 0.0, max_time=self.max_time)
+
+
+_pool = RenderPool(**configs.render.pool)
+
+
+def start_pool():
+    _pool.start()
+
+
+def shutdown_pool():
+    _pool.shutdown()
+
+
+def content_digest(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# blog id => 本进程最近一次渲染的正文的digest，这个版本的各个块在_blocks中，修改这篇文章时可以增量渲染
+_rendered = OrderedDict()
+
+
+def _remember(blog_id, content):
+    _rendered[blog_id] = content_digest(content)
+    _rendered.move_to_end(blog_id)
+    if len(_rendered) > _cache.max_entries:
+        _rendered.popitem(last=False)
+
+
+# 写入博客之前调用：渲染正文并记录渲染器版本，读取的时候就不用再渲染了。
+# 修改博客时previous是修改之前的正文，它是本进程最近渲染过的版本才尝试增量渲染
+async def render_blog(blog, previous=None):
+    incremental = previous is not None and _rendered.get(blog.id) == content_digest(previous)
+    blog.html_content = await _pool.render(blog.content, incremental)
+    blog.renderer = RENDERER
+    _remember(blog.id, blog.content)
+    return blog
+
+
+# 正在渲染的博客：(blog_id, digest) => Future，同一篇文章同时被多个请求读到时只渲染一次
+_rendering = dict()
+
+
+# 把博客正文渲染成HTML，预先渲染的结果仍然有效就直接使用，否则走缓存
+async def blog2html(blog):
+    if blog.get('renderer') == RENDERER and blog.get('html_content'):
+        return blog.html_content
+    digest = content_digest(blog.content)
+    html = _cache.get(blog.id, digest)
+    if html is not None:
+        return html
+    key = (blog.id, digest)
+    pending = _rendering.get(key)
+    if pending is not None:
+        html = await asyncio.shield(pending)
+        if html is not None:
+            return html
+        # 第一个请求渲染失败了，自己再渲染一次，错误照常抛给调用方
+        return await _pool.render(blog.content)
+    pending = asyncio.get_event_loop().create_future()
+    _rendering[key] = pending
+    html = None
+    try:
+        html = await _pool.render(blog.content)
+        _cache.put(blog.id, digest, html)
+        _remember(blog.id, blog.content)
+        return html
+    finally:
+        del _rendering[key]
+        pending.set_result(html)
+
+
+# 后台任务：按id顺序分批找出渲染器版本过期的博客，重新渲染并写回数据库。
+# 渲染可能要好几秒，这期间博客可能被修改，所以只写html_content和renderer两列，并且要求正文没有变化；
+# 渲染失败（比如超时）的博客记下日志跳过，按id往后取，不会反复选中同一篇
+async def rerender_stale_blogs(batch_size=20):
+    total = 0
+    failed = 0
+    last_id = ''
+    while True:
+        blogs = await Blog.findAll('`renderer`<>? and `id`>?', [RENDERER, last_id], orderBy='`id`', limit=batch_size)
+        if not blogs:
+            break
+        for blog in blogs:
+            last_id = blog.id
+            try:
+                html = await _pool.render(blog.content)
+            except Exception as e:
+                failed += 1
+                logging.warning('failed to re-render blog %s: %s' % (blog.id, e))
+                continue
+            rows = await orm.execute('update `blogs` set `html_content`=?, `renderer`=? where `id`=? and `content`=?',
+                                     [html, RENDERER, blog.id, blog.content])
+            if rows == 1:
+                total += 1
+                invalidate_blog(blog.id)
+            # 每渲染一篇就让出事件循环，不要阻塞正常的请求
+            await asyncio.sleep(0)
+    if total or failed:
+        logging.info('re-rendered %s stale blogs with %s, %s failed' % (total, RENDERER, failed))
+    return total
+
+
+def invalidate_blog(blog_id):
+    _cache.invalidate(blog_id)
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def pool_stats():
+    return _pool.stats()
+
+
+def block_stats():
+    return dict(entries=len(_blocks), max_entries=_blocks.max_entries, hits=_blocks.hits, misses=_blocks.misses)
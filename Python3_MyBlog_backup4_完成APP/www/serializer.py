@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+JSON serialization for responses, uses orjson when it is installed.
+'''
+
+import json, logging
+
+from aiohttp import web
+
+from config import configs
+
+import pagecache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_STREAM_THRESHOLD = configs.serializer.stream_threshold
+_CHUNK_SIZE = configs.serializer.chunk_size
+
+
+# Model继承自dict，JSON后端直接按dict处理，不会走到这里；
+# 这里只处理Page这类普通对象，以及其他dict的子类
+def _default(o):
+    if isinstance(o, dict):
+        return dict(o)
+    if isinstance(o, (set, frozenset, tuple)):
+        return list(o)
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+
+if orjson is not None:
+    def dumps(obj):
+        ' serialize obj to UTF-8 encoded JSON bytes. '
+        return orjson.dumps(obj, default=_default)
+else:
+    def dumps(obj):
+        ' serialize obj to UTF-8 encoded JSON bytes. '
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+logging.info('json backend: %s' % ('orjson' if orjson is not None else 'json'))
+
+
+# 返回dict中需要分块输出的大列表的key，没有则返回None
+def _large_list_key(r):
+    for k, v in r.items():
+        if isinstance(v, (list, tuple)) and len(v) >= _STREAM_THRESHOLD:
+            return k
+    return None
+
+
+def json_response(r):
+    resp = web.Response(body=dumps(r))
+    resp.content_type = 'application/json;charset=utf-8'
+    return resp
+
+
+# 列表很大的时候分块编码，每编码一块就写出去，不用先拼出一个完整的大bytes对象
+async def stream_json(request, r, key):
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    # 先写其他字段，最后写大列表
+    head = dict((k, v) for k, v in r.items() if k != key)
+    # 生成整页缓存的请求把写出的各块留下来，交给整页缓存
+    written = pagecache.stream_collector(request)
+    if head:
+        await _write(resp, written, dumps(head)[:-1] + b',' + dumps(key) + b':[')
+    else:
+        await _write(resp, written, b'{' + dumps(key) + b':[')
+    items = r[key]
+    for i in range(0, len(items), _CHUNK_SIZE):
+        chunk = dumps(list(items[i:i + _CHUNK_SIZE]))[1:-1]
+        await _write(resp, written, chunk if i == 0 else b',' + chunk)
+    await _write(resp, written, b']}')
+    await resp.write_eof()
+    if written is not None:
+        pagecache.set_streamed_body(resp, written)
+    return resp
+
+
+async def _write(resp, written, chunk):
+    if written is not None:
+        written.append(chunk)
+    await resp.write(chunk)
+
+
+async def dict_response(request, r):
+    ' build a JSON response for dict r, large lists are streamed. '
+    key = _large_list_key(r)
+    # 后台刷新整页缓存时不能分块输出
+    if key is None or pagecache.buffered(request):
+        return json_response(r)
+    return await stream_json(request, r, key)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Server bootstrap: event loop (uvloop when installed), AppRunner and TCP / Unix socket sites.
+
+Usage: python3 startup.py
+'''
+
+import logging, logconfig;logconfig.setup()
+
+import os, stat, socket, signal, asyncio
+
+import aiohttp
+
+from aiohttp import web
+
+from config import configs
+
+
+# uvloop的事件循环比asyncio自带的快不少，没有安装时使用asyncio自带的事件循环
+def install_uvloop():
+    if not configs.server.uvloop:
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        logging.info('uvloop is not installed, using the asyncio event loop.')
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logging.info('using uvloop %s event loop.' % uvloop.__version__)
+    return True
+
+
+def new_event_loop():
+    install_uvloop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+# 第一次部署时socket所在的目录可能还不存在；上次没有正常退出留下的socket文件要先删掉才能bind
+def _prepare_unix_socket(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# 监听configs.server.unix_socket，没有设置就监听host:port；多进程部署时主进程用它监听，再把socket交给工作进程
+def listen_socket(reuse_port=False):
+    server = configs.server
+    if server.unix_socket:
+        _prepare_unix_socket(server.unix_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(server.unix_socket)
+        # nginx和应用一般不是同一个用户，需要能够连接
+        os.chmod(server.unix_socket, 0o666)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((server.host, server.port))
+    sock.listen(server.backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def address():
+    server = configs.server
+    if server.unix_socket:
+        return 'unix:%s' % server.unix_socket
+    return 'http://%s:%s' % (server.host, server.port)
+
+
+# aiohttp 3.9开始shutdown_timeout是AppRunner的参数，site上的参数废弃了；
+# 3.8的AppRunner会把它传给RequestHandler，直接报TypeError，只能传给site。返回(runner的参数, site的参数)
+def _shutdown_timeout(timeout):
+    if tuple(int(v) for v in aiohttp.__version__.split('.')[:2]) >= (3, 9):
+        return dict(shutdown_timeout=timeout), dict()
+    return dict(), dict(shutdown_timeout=timeout)
+
+
+# 创建app并开始监听，sock为None时按照configs.server监听，返回的runner用来停止服务
+async def start(loop, sock=None, background=True):
+    import app
+    server = configs.server
+    web_app = await app.init_app(loop, background)
+    # 停止时等待正在处理的请求完成的秒数
+    runner_kw, site_kw = _shutdown_timeout(server.graceful_timeout)
+    runner = web.AppRunner(web_app, handle_signals=False, keepalive_timeout=server.keepalive_timeout,
+                           access_log=logging.getLogger('aiohttp.access') if server.access_log else None,
+                           access_log_format=server.access_log_format, **runner_kw)
+    await runner.setup()
+    if sock is not None:
+        site = web.SockSite(runner, sock, backlog=server.backlog, **site_kw)
+    elif server.unix_socket:
+        _prepare_unix_socket(server.unix_socket)
+        site = web.UnixSite(runner, server.unix_socket, backlog=server.backlog, **site_kw)
+    else:
+        site = web.TCPSite(runner, server.host, server.port, backlog=server.backlog, **site_kw)
+    await site.start()
+    if sock is None and server.unix_socket:
+        os.chmod(server.unix_socket, 0o666)
+    logging.info('server started at %s...' % address())
+    return runner
+
+
+# 优雅退出：不再接受新连接，等待正在处理的请求完成（最多graceful_timeout秒），再关闭连接池
+async def stop(runner):
+    import app
+    web_app = runner.app
+    await runner.cleanup()
+    await app.close_app(web_app)
+
+
+def run():
+    loop = new_event_loop()
+    runner = loop.run_until_complete(start(loop))
+    stopped = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stopped.done() or stopped.set_result(None))
+    try:
+        loop.run_until_complete(stopped)
+    finally:
+        logging.info('server stopping...')
+        loop.run_until_complete(stop(runner))
+        loop.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Validators and Cache-Control of the responses finished by conditional.py.
+
+Usage: python3 test_conditional.py
+'''
+
+import time, unittest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import conditional
+
+
+def _request(user=None, headers=None):
+    request = make_mocked_request('GET', '/', headers=headers)
+    request.__user__ = user
+    return request
+
+
+def _page(modified=None):
+    resp = web.Response(body=b'<p>page</p>')
+    if modified is not None:
+        conditional.set_last_modified(resp, modified)
+    return resp
+
+
+class CacheControlTest(unittest.TestCase):
+
+    def test_anonymous_page(self):
+        resp = conditional.finish(_request(), _page(time.time()))
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    def test_signed_in_page(self):
+        resp = conditional.finish(_request(user=dict(id='1')), _page(time.time()))
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+    def test_not_modified_keeps_cache_control(self):
+        tag = conditional.etag(b'<p>page</p>')
+        resp = conditional.finish(_request(headers={'If-None-Match': tag}), _page())
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    def test_not_modified_from_handler(self):
+        resp = conditional.set_last_modified(conditional.not_modified(), time.time())
+        resp = conditional.finish(_request(user=dict(id='1')), resp)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+    def test_explicit_cache_control_is_kept(self):
+        resp = _page(time.time())
+        resp.headers['Cache-Control'] = 'max-age=60'
+        resp = conditional.finish(_request(), resp)
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=60')
+
+    def test_response_without_validators(self):
+        resp = conditional.finish(_request(), web.Response(status=404))
+        self.assertNotIn('Cache-Control', resp.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Cursor pagination over rows that share created_at, run against an in-memory sqlite database.
+
+Usage: python3 test_cursor.py
+'''
+
+import asyncio, sqlite3, unittest
+
+import orm
+
+from apis import CursorPage
+from models import Blog, Comment
+
+
+# 用sqlite代替aiomysql的连接池，只实现orm.select/execute用到的接口
+class _Cursor(object):
+
+    def __init__(self, db):
+        self._cur = db.cursor()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self._cur.close()
+
+    async def execute(self, sql, args):
+        self._cur.execute(sql.replace('%s', '?'), args)
+        self.rowcount = self._cur.rowcount
+
+    async def fetchall(self):
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, row)) for row in self._cur.fetchall()]
+
+    async def fetchmany(self, size):
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, row)) for row in self._cur.fetchmany(size)]
+
+
+class _Connection(object):
+
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, cursor_class=None):
+        return _Cursor(self._db)
+
+
+class _Pool(object):
+
+    size = 1
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        self.db.execute('create table comments (id text primary key, blog_id text, user_id text, user_name text, '
+                        'user_image text, content text, created_at real)')
+        self._conn = _Connection(self.db)
+
+    async def acquire(self):
+        return self._conn
+
+    def release(self, conn):
+        pass
+
+
+class CursorPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = _Pool()
+        setattr(orm, '__pool', self.pool)
+        # 30条评论，每10条的created_at相同（同一时刻发表），id的顺序和插入的顺序无关
+        self.ids = []
+        for i in range(30):
+            c = Comment(id='%03d' % ((i * 7) % 30), blog_id='b1', user_id='u', user_name='n', user_image='',
+                        content='c%s' % i, created_at=1000.0 + i // 10)
+            self.pool.db.execute('insert into comments (id, blog_id, user_id, user_name, user_image, content, '
+                                 'created_at) values (?, ?, ?, ?, ?, ?, ?)',
+                                 (c.id, c.blog_id, c.user_id, c.user_name, c.user_image, c.content, c.created_at))
+            self.ids.append((c.created_at, c.id))
+        self.ids.sort(reverse=True)
+
+    def pages(self, load):
+        seen = []
+        cursor = ''
+        while True:
+            p = CursorPage(cursor, page_size=7)
+            seen.extend((c.created_at, c.id) for c in p.trim(asyncio.run(load(p))))
+            if not p.has_next:
+                return seen
+            cursor = p.next_cursor
+
+    def test_find_all(self):
+        self.assertEqual(self.pages(lambda p: Comment.findAll(limit=p.limit, after=p.after)), self.ids)
+
+    def test_related(self):
+        blog = Blog(id='b1')
+        self.assertEqual(self.pages(lambda p: blog.related('comments', limit=p.limit, after=p.after)), self.ids)
+
+    def test_prefetch(self):
+        blog = Blog(id='b1')
+        asyncio.run(Blog.prefetch([blog], ['comments']))
+        self.assertEqual([(c.created_at, c.id) for c in blog.comments], self.ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
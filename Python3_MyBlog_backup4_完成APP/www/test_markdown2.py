@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+The tokenizer engine of markdown2 must render exactly what the regex engine renders.
+
+Usage: python3 test_markdown2.py
+'''
+
+import unittest
+
+import markdown2
+
+# 各种块级结构以及它们容易出错的边界，每一项单独渲染，也两两拼接起来渲染
+CORPUS = [
+    'Just a paragraph.\nWith a second line.\n',
+    '# Header\n',
+    'Setext header\n=============\n',
+    'Setext header\n-------------\n',
+    '## Header with *emphasis* ##\n',
+    '* * *\n',
+    '---\n',
+    '    def f():\n        return 1\n',
+    '    code\n\n    more code after a blank line\n',
+    '- one\n- two\n- three\n',
+    '1. one\n2. two\n\n3. three after a blank line\n',
+    '- item\n\n    continued paragraph in the item\n',
+    '- item\n\n        code in the item\n',
+    '- outer\n    - inner\n    - inner\n- outer\n',
+    '- \n\n# Header\n',
+    '-   \n\n# Header\n',
+    '1.\t\n\nparagraph\n',
+    '*  \t\n\n    code\n',
+    '> quote\n> more quote\n',
+    '> quote\n\n> another quote\n',
+    '> - list in a quote\n> - second\n',
+    '<div>\nblock html\n</div>\n',
+    '<div>\n\nhtml with blank lines\n\n</div>\n',
+    '<!-- comment -->\n',
+    '<!-- comment -->\n\n<!-- comment -->\n\n<!-- another comment -->\n',
+    '\n<!-- c -->\nSetext\n------\n',
+    '<hr />\n',
+    '<p>inline <em>html</em> paragraph</p>\n',
+    'Text with <span>span html</span> and `code` and **strong**.\n',
+    'A [link](http://example.com/ "Title") and a [reference][r1].\n',
+    '[r1]: http://example.com/1 "One"\n',
+    'An image ![alt](/static/img.png) and an <http://example.com/auto> link.\n',
+    'Escapes \\*not emphasis\\* and \\`not code\\`.\n',
+    'Trailing spaces for a break  \nnext line\n',
+    'Tabs\tinside\ttext\n',
+]
+
+
+def _render(text, engine):
+    return markdown2.markdown(text, engine=engine)
+
+
+class EngineEquivalenceTest(unittest.TestCase):
+
+    def assertSameOutput(self, text):
+        self.assertEqual(_render(text, 'tokenizer'), _render(text, 'regex'), 'input: %r' % text)
+
+    def test_single(self):
+        for text in CORPUS:
+            with self.subTest(text=text):
+                self.assertSameOutput(text)
+
+    def test_pairs(self):
+        for a in CORPUS:
+            for b in CORPUS:
+                text = a + '\n' + b
+                with self.subTest(text=text):
+                    self.assertSameOutput(text)
+
+    def test_convert_iter(self):
+        # 分块输出的各段拼起来和convert()的结果相同，使用块缓存时也一样
+        for engine in ('regex', 'tokenizer'):
+            converter = markdown2.Markdown(engine=engine)
+            cache = markdown2.BlockCache()
+            for a in CORPUS:
+                for b in CORPUS:
+                    text = a + '\n' + b
+                    with self.subTest(engine=engine, text=text):
+                        expected = converter.convert(text)
+                        self.assertEqual(''.join(converter.convert_iter(text)), expected)
+                        self.assertEqual(''.join(converter.convert_iter(text, block_cache=cache)), expected)
+
+    def test_empty_item_with_trailing_spaces(self):
+        # 列表符号后面不止一个空格的空列表项，列表延续到下一个块，标题在列表项里面
+        self.assertEqual(_render('-   \n\n# Header\n', 'tokenizer'), '<ul>\n<li><h1>Header</h1></li>\n</ul>\n')
+
+    def test_comments_after_link_definition(self):
+        # 占位符比注释短，替换之后要从占位符后面继续找下一个注释，不能跳过它
+        text = '[r1]: http://example.com/1 "One"\n<!-- comment -->\n\n<!-- comment -->\n\n'
+        for engine in ('regex', 'tokenizer'):
+            self.assertEqual(_render(text, engine), '<!-- comment -->\n\n<!-- comment -->\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*-encoding:UTF-8-*-
+
+__author__ = 'Toohoo Lee'
+
+'''
+Full-page cache of streamed pages, run against an aiohttp test server with the middlewares of app.py.
+
+Usage: python3 test_pagecache.py
+'''
+
+import asyncio, unittest
+
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer
+from jinja2 import Environment, DictLoader
+
+import app, pagecache
+
+from coroweb import get, cached, RequestHandler
+
+# 比流式输出的一块大，分好几块写出去
+_BODY = 'x' * (100 * 1024)
+
+
+class StreamedPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.renders = 0
+        self.streamed = []
+        # 过期之后马上在后台刷新
+        self.saved = pagecache._cache
+        pagecache._cache = pagecache.PageCache(ttl=0, stale_ttl=60)
+
+    def tearDown(self):
+        pagecache._cache = self.saved
+
+    async def server(self):
+        @get('/big')
+        @cached('big')
+        async def big(request):
+            self.renders += 1
+            await asyncio.sleep(0.05)
+            return {'__template__': 'big.html', 'body': _BODY, '__stream__': True}
+
+        async def record(a, handler):
+            async def streamed(request):
+                resp = await handler(request)
+                self.streamed.append(not isinstance(resp, web.Response))
+                return resp
+            return streamed
+
+        application = web.Application(middlewares=[
+            app.auth_factory, app.conditional_factory, app.cache_factory, record, app.response_factory
+        ])
+        application['__templating__'] = Environment(loader=DictLoader({'big.html': '<p>{{ body }}</p>'}))
+        # 测试运行在新版本的Python上，没有asyncio.coroutine，不经过add_route直接注册
+        application.router.add_route('GET', '/big', RequestHandler(application, big))
+        server = TestServer(application)
+        await server.start_server()
+        return server
+
+    def run_test(self, test):
+        async def main():
+            server = await self.server()
+            try:
+                await test(server)
+            finally:
+                await server.close()
+        asyncio.run(main())
+
+    def test_refresh_does_not_write_to_the_connection(self):
+        async def test(server):
+            reader, writer = await asyncio.open_connection(server.host, server.port)
+            request = ('GET /big HTTP/1.1\r\nHost: %s\r\n\r\n' % server.host).encode('ascii')
+            data = b''
+            # 第一个请求生成缓存，第二个请求命中过期的页面，并在后台刷新
+            for _ in range(2):
+                writer.write(request)
+                await writer.drain()
+                await asyncio.sleep(0.3)
+            try:
+                while True:
+                    data += await asyncio.wait_for(reader.read(65536), 0.3)
+            except asyncio.TimeoutError:
+                pass
+            writer.close()
+            self.assertEqual(self.renders, 2)
+            self.assertEqual(data.count(b'HTTP/1.1 200'), 2)
+            # 后台刷新生成的是完整的响应，不是分块输出
+            self.assertEqual(self.streamed, [True, False])
+        self.run_test(test)
+
+    def test_waiters_use_the_streamed_page(self):
+        async def test(server):
+            pagecache._cache.ttl = 60
+            url = 'http://%s:%s/big' % (server.host, server.port)
+            async with ClientSession() as session:
+                async def fetch():
+                    async with session.get(url) as resp:
+                        return await resp.text()
+                bodies = await asyncio.gather(*[fetch() for _ in range(4)])
+            self.assertEqual(self.renders, 1)
+            self.assertEqual(bodies, ['<p>%s</p>' % _BODY] * 4)
+        self.run_test(test)
+
+
+if __name__ == '__main__':
+    unittest.main()